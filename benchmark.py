@@ -0,0 +1,289 @@
+# coding: utf-8
+"""Микробенчмарки горячих мест тестового стенда на синтетических каталогах.
+
+python benchmark.py               -- прогнать все бенчмарки и сохранить результат в results_file
+python benchmark.py compare FILE  -- то же и сравнить с сохранённым ранее результатом FILE
+
+Каждый бенчмарк для каждого размера каталога выполняется в отдельном процессе, чтобы пиковое
+потребление памяти (ru_maxrss) относилось только к нему.
+"""
+import os
+import sys
+import json
+import random
+import resource
+import subprocess
+import logging
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from utils import monotonic
+from catalog import ChartRecord, read_catalog, keep_idvers
+from test import Test
+
+
+_config = {
+    "sizes": [1000, 10000, 100000],
+    "repeat": 3,
+    # сколько поисков XPath-запросом выполнять (каждый -- полный обход дерева)
+    "xpath_lookups": 50,
+    # сколько объектов ждёт опрос track_* (фильтр read_catalog)
+    "pending_objects": 100,
+    "data_dir": "data/put_new_objects",
+    "work_dir": "results/benchmark",
+    "results_file": "results/benchmark.json",
+    # во сколько раз (доля) результат может ухудшиться без пометки "регрессия"
+    "regression_threshold": 0.1
+}
+
+# Атрибуты метаданных синтетического объекта (как у листов O-35)
+METADATA_ATTRS = ['c103', 'c114', 'c122', 'c201', 'c202', 'c203', 'c205', 'c210', 'c215', 'c234',
+                  'c235', 'c236', 'c237.1', 'c250', 'c251', 'c296', 'c303', 'c304', 'c306', 'c702',
+                  'c703'] + ['c208.%d.%d' % (i, j) for i in range(1, 5) for j in (1, 2)] + \
+                 ['c209.%d.%d' % (i, j) for i in range(1, 5) for j in (1, 2)]
+
+
+def synthetic_chart(i):
+    """Атрибуты i-го синтетического объекта каталога"""
+    attrs = {'ID': str(100000 + i), 'Issue': '1', 'Name': 'SYN-%06d_.sxf' % i,
+             'Class': '121110', 'Type': 'SXF', 'Updated': '%.6f' % (1479370000 + i)}
+    for attr in METADATA_ATTRS:
+        attrs[attr] = '%s-%d' % (attr, i)
+    return attrs
+
+
+def make_catalog_zip(size, zipfilename):
+    """Записать zip-архив с каталогом WF.CLL из size объектов (xml пишется потоково)"""
+    xmlfilename = zipfilename + '.WF.CLL'
+    with open(ensure_dir(xmlfilename), 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<CATALOG Created="1479370000.0">\n')
+        for i in xrange(size):
+            f.write('<CHART %s/>\n' % ' '.join('%s="%s"' % item
+                                               for item in sorted(synthetic_chart(i).iteritems())))
+        f.write('</CATALOG>\n')
+    with ZipFile(zipfilename, 'w', ZIP_DEFLATED) as zf:
+        zf.write(xmlfilename, 'WF.CLL')
+    os.remove(xmlfilename)
+
+
+def ensure_dir(path):
+    """Создать каталог для файла path, если его нет; вернуть path"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return path
+
+
+class Response(object):
+    """Ответ сервера на GetCatalog (то, что нужно Test.open_xml_from_zip_from_response)"""
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+
+
+class OfflineSession(object):
+    """Заглушка сессии: методам Test, которые не обращаются к серверу, нужно только имя"""
+    server = 'benchmark'
+
+
+def make_test(config):
+    """Test без подключения к серверам: бенчмаркам нужны только его методы обработки данных"""
+    test = Test.__new__(Test)
+    test.config = {'results_dir': config['work_dir'], 'save_catalog_zips': False}
+    test.logger = logging.getLogger('benchmark')
+    test.secondary_names = ['secondary']
+    test.sessions = {'secondary': OfflineSession()}
+    test.datasets = {}
+    test.uploaded_objects = {}
+    test.replicated_objects = {'secondary': {}}
+    return test
+
+
+def catalog_response(config, size):
+    zipfilename = '%s/catalog_%d.zip' % (config['work_dir'], size)
+    if not os.path.isfile(zipfilename):
+        make_catalog_zip(size, ensure_dir(zipfilename))
+    with open(zipfilename, 'rb') as f:
+        return Response(f.read())
+
+
+def timed(func, repeat):
+    """Лучшее из repeat время выполнения func()"""
+    best = None
+    for _ in xrange(repeat):
+        time0 = monotonic()
+        func()
+        seconds = monotonic() - time0
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+# Бенчмарки: name -> функция(config, size), возвращающая (число операций, единица, func)
+def bench_parse_tree(config, size):
+    """Разбор каталога в дерево (get_tree_from_xml_from_zip_from_response)"""
+    test = make_test(config)
+    response = catalog_response(config, size)
+    return size, 'CHART', lambda: test.get_tree_from_xml_from_zip_from_response(
+        response, 'GetCatalog.zip', 'WF.CLL')
+
+
+def bench_read_catalog(config, size):
+    """Потоковый разбор каталога в индексированный снимок (download_catalog_snapshot)"""
+    test = make_test(config)
+    response = catalog_response(config, size)
+
+    def func():
+        with test.open_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL') as xmlfile:
+            read_catalog(xmlfile)
+    return size, 'CHART', func
+
+
+def bench_read_catalog_keep(config, size):
+    """Потоковый разбор каталога с фильтром pending_objects ожидаемых объектов
+    (как при опросе в track_replicas)
+    """
+    test = make_test(config)
+    response = catalog_response(config, size)
+    rng = random.Random(1)
+    keep = keep_idvers((str(100000 + rng.randrange(size)), '1')
+                       for _ in xrange(config['pending_objects']))
+
+    def func():
+        with test.open_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL') as xmlfile:
+            read_catalog(xmlfile, keep)
+    return size, 'CHART', func
+
+
+def bench_lookup_xpath(config, size):
+    """Поиск объекта по (ID, Issue) XPath-запросом по дереву (как в циклах track_* раньше)"""
+    test = make_test(config)
+    tree = test.get_tree_from_xml_from_zip_from_response(catalog_response(config, size),
+                                                         'GetCatalog.zip', 'WF.CLL')
+    rng = random.Random(1)
+    idvers = [(str(100000 + rng.randrange(size)), '1') for _ in xrange(config['xpath_lookups'])]
+
+    def func():
+        for id, version in idvers:
+            tree.find('.//CHART[@ID="%s"][@Issue="%s"]' % (id, version))
+    return len(idvers), 'lookup', func
+
+
+def bench_lookup_snapshot(config, size):
+    """Поиск объекта по (ID, Issue) в индексированном снимке (CatalogSnapshot.find)"""
+    test = make_test(config)
+    with test.open_xml_from_zip_from_response(catalog_response(config, size),
+                                              'GetCatalog.zip', 'WF.CLL') as xmlfile:
+        catalog = read_catalog(xmlfile)
+    idvers = [(str(100000 + i), '1') for i in xrange(size)]
+
+    def func():
+        for id, version in idvers:
+            catalog.find(id, version)
+    return len(idvers), 'lookup', func
+
+
+def bench_compare(config, size):
+    """compare_uploaded_and_replicated_objects для size объектов"""
+    test = make_test(config)
+    for i in xrange(size):
+        attrs = synthetic_chart(i)
+        idver = (attrs['ID'], attrs['Issue'])
+        test.uploaded_objects[idver] = ChartRecord.from_items(
+                (attr, value) for attr, value in attrs.iteritems()
+                if attr not in ('ID', 'Issue', 'Updated'))
+        test.replicated_objects['secondary'][idver] = ChartRecord.from_items(attrs.iteritems())
+    return size, 'object', test.compare_uploaded_and_replicated_objects
+
+
+def bench_names_from_pairs(config, size):
+    """get_names_from_pairs для пар из data_dir, каждый раз с пустым кэшем манифестов
+    (size не используется: число пар определяется набором данных)
+    """
+    pairs = make_test(config).get_pairs(config['data_dir'])
+
+    def func():
+        make_test(config).get_names_from_pairs(pairs)
+    return len(pairs), 'pair', func
+
+
+BENCHMARKS = [
+    ('parse_tree', bench_parse_tree),
+    ('read_catalog', bench_read_catalog),
+    ('read_catalog_keep', bench_read_catalog_keep),
+    ('lookup_xpath', bench_lookup_xpath),
+    ('lookup_snapshot', bench_lookup_snapshot),
+    ('compare', bench_compare),
+    ('names_from_pairs', bench_names_from_pairs),
+]
+# бенчмарки, не зависящие от размера каталога, выполняются один раз
+SIZELESS_BENCHMARKS = frozenset(['names_from_pairs'])
+
+
+def run_one(config, name, size):
+    """Выполнить бенчмарк name в текущем процессе; вернуть результат"""
+    bench = dict(BENCHMARKS)[name]
+    ops, unit, func = bench(config, size)
+    setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds = timed(func, config['repeat'])
+    return {
+        'name': name,
+        'size': size,
+        'ops': ops,
+        'unit': unit,
+        'seconds': seconds,
+        'ops_per_sec': ops / seconds if seconds > 0 else None,
+        'setup_rss_kb': setup_rss,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_all(config):
+    """Выполнить все бенчмарки, каждый в отдельном процессе"""
+    results = []
+    for name, bench in BENCHMARKS:
+        sizes = config['sizes'][:1] if name in SIZELESS_BENCHMARKS else config['sizes']
+        for size in sizes:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                              'run', name, str(size)])
+            result = json.loads(output)
+            results.append(result)
+            print (u'%-18s %7d  %12.1f %s/s  %8.1f МБ' %
+                   (name, size, result['ops_per_sec'], result['unit'],
+                    result['peak_rss_kb'] / 1024.0)).encode('utf-8')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Вывести изменения относительно baseline; вернуть число регрессий"""
+    old = dict(((r['name'], r['size']), r) for r in baseline)
+    regressions = 0
+    for result in results:
+        base = old.get((result['name'], result['size']))
+        if base is None or not base['ops_per_sec'] or not result['ops_per_sec']:
+            continue
+        speed = result['ops_per_sec'] / base['ops_per_sec']
+        memory = float(result['peak_rss_kb']) / base['peak_rss_kb']
+        mark = ''
+        if speed < 1 - threshold or memory > 1 + threshold:
+            mark = u'  <-- регрессия'
+            regressions += 1
+        print (u'%-18s %7d  скорость x%.2f  память x%.2f%s' %
+               (result['name'], result['size'], speed, memory, mark)).encode('utf-8')
+    return regressions
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    if len(sys.argv) == 4 and sys.argv[1] == 'run':
+        print json.dumps(run_one(_config, sys.argv[2], int(sys.argv[3])))
+        sys.exit(0)
+
+    baseline = None
+    if len(sys.argv) == 3 and sys.argv[1] == 'compare':
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+    results = run_all(_config)
+    with open(ensure_dir(_config['results_file']), 'w') as f:
+        json.dump(results, f, indent=2)
+    print 'Результаты сохранены в %s' % _config['results_file']
+    if baseline is not None:
+        sys.exit(1 if compare(results, baseline, _config['regression_threshold']) else 0)
@@ -0,0 +1,165 @@
+# coding: utf-8
+from itertools import izip
+
+from lxml import etree
+
+# Атрибуты CHART, которые нужны тестам, помимо атрибутов метаданных cXXX
+CHART_ATTRS = frozenset(['ID', 'Issue', 'Name', 'Class', 'Type', 'Updated'])
+
+
+class ChartSchema(object):
+    """Упорядоченный набор имён атрибутов. Один экземпляр разделяется всеми записями
+    с одинаковым составом атрибутов, поэтому имена в каждой записи не хранятся.
+    """
+    __slots__ = ('names', 'index')
+    _schemas = {}  # names -> ChartSchema
+
+    def __init__(self, names):
+        self.names = names
+        self.index = dict((name, i) for i, name in enumerate(names))
+
+    @classmethod
+    def get(cls, names):
+        """Вернуть общую схему для кортежа имён (имена интернируются)"""
+        schema = cls._schemas.get(names)
+        if schema is None:
+            names = tuple(intern(str(name)) for name in names)
+            schema = cls._schemas.setdefault(names, cls(names))
+        return schema
+
+
+class ChartRecord(object):
+    """Компактная неизменяемая запись об объекте: атрибут -> значение.
+    Поддерживает ту часть интерфейса словаря, которой пользуются тесты.
+    """
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    @classmethod
+    def from_items(cls, items):
+        items = sorted(items)
+        schema = ChartSchema.get(tuple(attr for attr, value in items))
+        return cls(schema, tuple(value for attr, value in items))
+
+    def get(self, attr, default=None):
+        i = self.schema.index.get(attr)
+        if i is None:
+            return default
+        return self.values[i]
+
+    def __getitem__(self, attr):
+        return self.values[self.schema.index[attr]]
+
+    def __contains__(self, attr):
+        return attr in self.schema.index
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.schema.names)
+
+    def iterkeys(self):
+        return iter(self.schema.names)
+
+    def iteritems(self):
+        return izip(self.schema.names, self.values)
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return 'ChartRecord(%r)' % self.to_dict()
+
+
+def compact_chart(chart):
+    """Скопировать из элемента CHART только нужные тестам атрибуты"""
+    return ChartRecord.from_items((attr, value) for attr, value in chart.attrib.iteritems()
+                                  if attr in CHART_ATTRS or attr.startswith('c'))
+
+
+def iter_charts(context, keep=None):
+    """Отдавать записи CHART из iterparse-контекста, вычищая разобранные элементы,
+    чтобы дерево в памяти не росло. keep(элемент CHART) -- отдавать только те CHART'ы,
+    для которых он истинен.
+    """
+    for event, chart in context:
+        if keep is None or keep(chart):
+            yield compact_chart(chart)
+        chart.clear()
+        while chart.getprevious() is not None:
+            del chart.getparent()[0]
+
+
+def keep_idvers(idvers):
+    """Фильтр для read_catalog: только CHART'ы с (ID, Issue) из idvers"""
+    idvers = frozenset(idvers)
+    return lambda chart: (chart.get('ID'), chart.get('Issue')) in idvers
+
+
+def keep_ids(ids):
+    """Фильтр для read_catalog: только CHART'ы с ID из ids"""
+    ids = frozenset(ids)
+    return lambda chart: chart.get('ID') in ids
+
+
+def keep_names(names):
+    """Фильтр для read_catalog: только CHART'ы с (Name, Class) из names"""
+    names = frozenset(names)
+    return lambda chart: (chart.get('Name'), chart.get('Class')) in names
+
+
+def read_catalog(xmlfile, keep=None):
+    """Потоково прочитать каталог (WF.CLL) из файла xmlfile и вернуть CatalogSnapshot.
+    Дерево в памяти не строится, но каждый оставленный CHART хранится записью в индексах
+    снимка, так что без фильтра keep (см. iter_charts, keep_idvers, keep_names) память растёт
+    с размером каталога. С фильтром в памяти остаются только нужные записи, а отброшенные
+    CHART'ы не копируются.
+    """
+    context = etree.iterparse(xmlfile, events=('end',), tag='CHART')
+    snapshot = CatalogSnapshot(iter_charts(context, keep))
+    # корневой элемент становится доступен только по окончании разбора
+    snapshot.created = context.root.get('Created')
+    return snapshot
+
+
+class CatalogSnapshot(object):
+    """Индексированный снимок каталога (ответа GetCatalog).
+    Строится один раз на каждый ответ сервера, после чего поиск объектов выполняется по
+    хэш-индексам, а не XPath-запросами по всему дереву.
+    charts -- записи CHART (см. read_catalog) или сами элементы CHART
+    """
+    def __init__(self, charts=(), created=None):
+        self.created = created
+        self.by_idver = {}  # (ID, Issue) -> CHART
+        self.by_id = {}  # ID -> CHART
+        self.by_name = {}  # (Name, Class) -> CHART
+        for chart in charts:
+            self.add(chart)
+
+    def add(self, chart):
+        # setdefault: как и tree.find, возвращаем первое вхождение
+        id = chart.get('ID')
+        self.by_idver.setdefault((id, chart.get('Issue')), chart)
+        self.by_id.setdefault(id, chart)
+        self.by_name.setdefault((chart.get('Name'), chart.get('Class')), chart)
+
+    def __len__(self):
+        return len(self.by_idver)
+
+    def __iter__(self):
+        return self.by_idver.itervalues()
+
+    def find(self, id, version):
+        """Вернуть CHART с заданными ID и Issue или None"""
+        return self.by_idver.get((id, version))
+
+    def find_by_id(self, id):
+        return self.by_id.get(id)
+
+    def find_by_name(self, name, class_):
+        return self.by_name.get((name, class_))
+
@@ -0,0 +1,125 @@
+# coding: utf-8
+import os
+import json
+import zlib
+from uuid import uuid4
+
+from lxml import etree
+
+from catalog import ChartRecord
+from upload_cache import CHUNK_SIZE, pair_sha256
+
+# Версия формата манифеста; манифест другой версии строится заново
+MANIFEST_VERSION = 1
+
+
+def file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return '%08x' % (crc & 0xffffffff)
+
+
+def file_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def read_object_xml(xmlfile):
+    """Разобрать xml-файл объекта: Name, Class, Type, атрибуты и теги"""
+    tree = etree.parse(xmlfile)
+    chart = tree.find('.//chart')
+    return {
+        'Name': chart.get('Name'),
+        'Class': chart.get('Class'),
+        'Type': chart.get('Type'),
+        'attributes': dict((attribute.get('name'), attribute.get('value'))
+                           for attribute in tree.findall('.//Attribute')),
+        'tags': [tag.get('id') for tag in tree.findall('.//tags/tag')],
+    }
+
+
+def read_pair(zipfile, xmlfile, digest=None):
+    """Запись манифеста для пары (zip-файл, xml-файл)"""
+    entry = read_object_xml(xmlfile)
+    entry['zip_stat'] = file_stat(zipfile)
+    entry['xml_stat'] = file_stat(xmlfile)
+    entry['zip_crc32'] = file_crc32(zipfile)
+    entry['sha256'] = digest or pair_sha256(zipfile, xmlfile)
+    return entry
+
+
+def chart_record(entry):
+    """Запись об объекте (Class, Name, Type и атрибуты), как её потом покажет каталог"""
+    items = dict(entry['attributes'])
+    items['Class'] = entry['Class']
+    items['Name'] = entry['Name']
+    items['Type'] = entry['Type']
+    return ChartRecord.from_items(items.iteritems())
+
+
+class Dataset(object):
+    """Манифест набора данных: сведения о каждой паре (zip-файл, xml-файл) каталога.
+    xml-файлы разбираются один раз; если задан manifest_file, манифест сохраняется в нём и при
+    следующем запуске используется повторно. Запись пары обновляется, если у какого-то из
+    файлов изменились размер или mtime, причём при совпадении SHA-256 пары xml не разбирается.
+    pairs -- [(zip-файл, xml-файл), ...]
+    """
+    def __init__(self, pairs, manifest_file=None):
+        self.pairs = pairs
+        self.manifest_file = manifest_file
+        self.entries = {}  # xml-файл -> запись манифеста
+        self.updated = 0  # сколько записей пришлось построить заново
+        old_entries = self.load()
+        for zipfile, xmlfile in pairs:
+            key = os.path.basename(xmlfile)
+            entry = old_entries.get(key)
+            if entry is None:
+                entry = read_pair(zipfile, xmlfile)
+                self.updated += 1
+            elif entry['zip_stat'] != file_stat(zipfile) or entry['xml_stat'] != file_stat(xmlfile):
+                digest = pair_sha256(zipfile, xmlfile)
+                if digest == entry['sha256']:
+                    entry['zip_stat'] = file_stat(zipfile)
+                    entry['xml_stat'] = file_stat(xmlfile)
+                else:
+                    entry = read_pair(zipfile, xmlfile, digest)
+                self.updated += 1
+            self.entries[xmlfile] = entry
+        if self.updated or len(old_entries) != len(pairs):
+            self.save()
+
+    def load(self):
+        """Вернуть записи сохранённого манифеста: имя xml-файла -> запись"""
+        if self.manifest_file is None or not os.path.isfile(self.manifest_file):
+            return {}
+        try:
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+        except ValueError:
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest['entries']
+
+    def save(self):
+        if self.manifest_file is None:
+            return
+        directory = os.path.dirname(self.manifest_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        entries = dict((os.path.basename(xmlfile), entry)
+                       for xmlfile, entry in self.entries.iteritems())
+        # у каждого писателя свой временный файл: манифест могут сохранять параллельные тесты
+        tmpfile = '%s.%s.tmp' % (self.manifest_file, uuid4().hex)
+        with open(tmpfile, 'w') as f:
+            json.dump({'version':MANIFEST_VERSION, 'entries':entries}, f, indent=1, sort_keys=True)
+        os.rename(tmpfile, self.manifest_file)
+
+    def __getitem__(self, xmlfile):
+        return self.entries[xmlfile]
+
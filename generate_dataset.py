@@ -0,0 +1,199 @@
+# coding: utf-8
+"""Генератор большого синтетического набора данных для нагрузочных прогонов.
+Пары (zip-файл, xml-файл) из source_new_objects_dir и source_new_versions_dir клонируются
+в count листов с уникальными именами: у каждого клона свои Name, c202, c122, parcel_id и
+сдвинутые координаты рамки (c208.*, c209.*). Размер архивов задаётся распределением
+size_distribution: в архив добавляется файл-заполнитель случайного содержимого.
+Каждый файл пишется потоково через временный файл, поэтому в памяти не бывает больше одной
+порции данных.
+
+python generate_dataset.py [count]
+"""
+import os
+import sys
+import random
+import shutil
+import tempfile
+from uuid import uuid4
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
+
+from lxml import etree
+
+from utils import get_logger
+
+
+_config = {
+    "source_new_objects_dir": "data/put_new_objects",
+    "source_new_versions_dir": "data/put_new_versions",
+    "new_objects_dir": "data/generated/put_new_objects",
+    "new_versions_dir": "data/generated/put_new_versions",
+    "count": 1000,
+    "name_format": "SYN-%06d_.sxf",
+    # [размер заполнителя в байтах, вес]
+    "size_distribution": [[0, 0.6], [1048576, 0.3], [10485760, 0.1]],
+    # сколько рядов листов укладывается по широте, прежде чем начать следующую колонку
+    "rows": 60,
+    "seed": 1,
+    "loglevel": "INFO_OK"
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def choose_size(rng, distribution):
+    """Выбрать размер заполнителя по распределению [[размер, вес], ...]"""
+    total = sum(weight for size, weight in distribution)
+    x = rng.uniform(0, total)
+    for size, weight in distribution:
+        x -= weight
+        if x <= 0:
+            return size
+    return distribution[-1][0]
+
+
+def copy_to_tempfile(src, directory):
+    """Потоково скопировать файловый объект src во временный файл; вернуть его путь"""
+    fd, path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(src, f, CHUNK_SIZE)
+    return path
+
+
+def write_filler(size, directory):
+    """Временный файл размером size байт со случайным (несжимаемым) содержимым"""
+    fd, path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        while size > 0:
+            chunk = os.urandom(min(size, CHUNK_SIZE))
+            f.write(chunk)
+            size -= len(chunk)
+    return path
+
+
+def shift_value(value, delta):
+    """Сдвинуть число в строке value на delta, сохранив число знаков после запятой"""
+    decimals = len(value.split('.')[1]) if '.' in value else 0
+    return '%.*f' % (decimals, float(value) + delta)
+
+
+def frame_span(attributes, prefix, axis):
+    """Протяжённость рамки листа по оси axis (1 или 2) для атрибутов prefix.N.axis"""
+    values = [float(attribute.get('value')) for name, attribute in attributes.iteritems()
+              if name.startswith(prefix) and name.endswith('.%d' % axis)]
+    return max(values) - min(values) if values else 0
+
+
+def clone_xml(srcfile, dstfile, name, number, row, col):
+    """Записать в dstfile xml-файл объекта name: номер листа number, рамка сдвинута на row
+    листов по широте и col листов по долготе.
+    """
+    tree = etree.parse(srcfile)
+    tree.find('.//header').set('parcel_id', uuid4().hex)
+    tree.find('.//chart').set('Name', name)
+    attributes = dict((attribute.get('name'), attribute)
+                      for attribute in tree.findall('.//Attribute'))
+    stem = os.path.splitext(name)[0].rstrip('_')
+    if 'c202' in attributes:
+        attributes['c202'].set('value', '0.%s' % stem)
+    if 'c122' in attributes:
+        attributes['c122'].set('value', u'%s %06d' % (attributes['c122'].get('value'), number))
+    # c208.N.1/c208.N.2 -- широта/долгота углов рамки, c209.N.1/c209.N.2 -- прямоугольные
+    # координаты; сдвиг на целое число листов (проекция при этом не пересчитывается)
+    for prefix in ('c208.', 'c209.'):
+        deltas = {1: row * frame_span(attributes, prefix, 1),
+                  2: col * frame_span(attributes, prefix, 2)}
+        for attr_name, attribute in attributes.iteritems():
+            if attr_name.startswith(prefix):
+                axis = int(attr_name.rsplit('.', 1)[1])
+                attribute.set('value', shift_value(attribute.get('value'), deltas[axis]))
+    tmpfile = '%s.tmp' % dstfile
+    tree.write(tmpfile, encoding='utf-8', xml_declaration=True)
+    os.rename(tmpfile, dstfile)
+
+
+def clone_zip(srcfile, dstfile, src_name, name, filler_size):
+    """Записать в dstfile архив объекта name: члены архива srcfile с src_name в пути,
+    заменённым на name, и заполнитель размером filler_size байт.
+    """
+    directory = os.path.dirname(dstfile)
+    tmpfile = '%s.tmp' % dstfile
+    with ZipFile(srcfile) as zin:
+        with ZipFile(tmpfile, 'w', allowZip64=True) as zout:
+            infos = zin.infolist()
+            for info in infos:
+                arcname = info.filename.replace(src_name, name)
+                if arcname.endswith('/'):
+                    zout.writestr(ZipInfo(arcname), '')
+                    continue
+                src = zin.open(info)
+                try:
+                    path = copy_to_tempfile(src, directory)
+                finally:
+                    src.close()
+                try:
+                    zout.write(path, arcname, info.compress_type)
+                finally:
+                    os.remove(path)
+            if filler_size:
+                path = write_filler(filler_size, directory)
+                arcdir = os.path.dirname(infos[0].filename.replace(src_name, name)) if infos else name
+                try:
+                    zout.write(path, '%s/filler.bin' % arcdir, ZIP_STORED)
+                finally:
+                    os.remove(path)
+    os.rename(tmpfile, dstfile)
+
+
+def get_source_pairs(directory):
+    """[(имя объекта, zip-файл, xml-файл), ...] исходного каталога"""
+    pairs = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.zip'):
+            stem = filename[:-len('.zip')]
+            pairs.append((stem, os.path.join(directory, filename),
+                          os.path.join(directory, stem + '.xml')))
+    return pairs
+
+
+def generate(config, logger):
+    sources = get_source_pairs(config['source_new_objects_dir'])
+    if not sources:
+        raise RuntimeError(u'В каталоге %s нет исходных объектов' % config['source_new_objects_dir'])
+    versions_dir = config['source_new_versions_dir']
+    for directory in (config['new_objects_dir'], config['new_versions_dir']):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    rng = random.Random(config['seed'])
+    total_size = 0
+    for i in xrange(config['count']):
+        src_name, zipfile, xmlfile = sources[i % len(sources)]
+        name = config['name_format'] % i
+        # первые len(sources) клонов сдвинуты на один лист от исходных, следующие -- на два и т.д.
+        k = i // len(sources) + 1
+        row, col = k % config['rows'], k // config['rows']
+        outputs = [(zipfile, xmlfile, config['new_objects_dir'])]
+        version_zipfile = os.path.join(versions_dir, src_name + '.zip')
+        if os.path.isfile(version_zipfile):
+            outputs.append((version_zipfile, os.path.join(versions_dir, src_name + '.xml'),
+                            config['new_versions_dir']))
+        for src_zipfile, src_xmlfile, directory in outputs:
+            filler_size = choose_size(rng, config['size_distribution'])
+            dstfile = os.path.join(directory, name + '.zip')
+            clone_zip(src_zipfile, dstfile, src_name, name, filler_size)
+            clone_xml(src_xmlfile, os.path.join(directory, name + '.xml'), name, i, row, col)
+            total_size += os.path.getsize(dstfile)
+        if (i + 1) % 100 == 0:
+            logger.info(u'Сгенерировано объектов: %d из %d' % (i + 1, config['count']))
+    logger.info_ok(u'Сгенерировано объектов: %d, суммарный размер архивов %.1f МБ' %
+                   (config['count'], total_size / 1048576.0))
+
+
+# Preliminaries
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    if len(sys.argv) > 1:
+        _config['count'] = int(sys.argv[1])
+    logger = get_logger('colorlog', _config['loglevel'])
+
+    # Action
+    generate(_config, logger)
@@ -0,0 +1,94 @@
+# coding: utf-8
+import os
+import csv
+from threading import Thread, Event
+from time import time
+
+from utils import monotonic
+
+# Столбцы временного ряда
+COLUMNS = ['time', 'elapsed', 'server', 'primary', 'secondary', 'missing', 'extra',
+           'oldest_missing_age']
+
+
+class LagSampler(Thread):
+    """Фоновый замер отставания нижестоящих серверов для долгих прогонов.
+    Раз в interval секунд снимаются каталоги вышестоящего и всех нижестоящих серверов и для
+    каждого нижестоящего в filename дописывается строка: сколько (ID, Issue) есть на вышестоящем,
+    но нет на нижестоящем (missing), сколько наоборот (extra -- например, не дошедшие удаления) и
+    возраст старейшего недошедшего объекта (по Updated и Created каталога вышестоящего сервера,
+    т.е. по его часам). Файл только дописывается, каждая строка сбрасывается на диск сразу.
+    listeners -- функции listener(момент запроса, каталог вышестоящего, {имя сессии: каталог}),
+    вызываемые после каждого замера.
+    Каталоги всегда снимаются целиком (from=0), иначе extra не увидеть.
+    """
+    def __init__(self, test, interval, filename, listeners=()):
+        super(LagSampler, self).__init__()
+        self.daemon = True
+        self.test = test
+        self.logger = test.logger
+        self.interval = interval
+        self.filename = filename
+        self.listeners = list(listeners)
+        self.stopped = Event()
+        self.time0 = monotonic()
+
+    def get_catalog(self, session):
+        return self.test.download_catalog_snapshot(session, 0)
+
+    @staticmethod
+    def oldest_age(primary, idvers):
+        """Возраст (по часам вышестоящего сервера) старейшего из объектов idvers"""
+        updated = []
+        for idver in idvers:
+            try:
+                updated.append(float(primary.find(*idver).get('Updated')))
+            except (TypeError, ValueError):
+                pass
+        if not updated or primary.created is None:
+            return 0
+        return max(float(primary.created) - min(updated), 0)
+
+    def sample(self):
+        """Снять каталоги, дописать строки в filename и оповестить listeners"""
+        time_requested = monotonic()
+        primary = self.get_catalog(self.test.sessions['primary'])
+        catalogs = {}
+        for session_name in self.test.secondary_names:
+            catalogs[session_name] = self.get_catalog(self.test.sessions[session_name])
+        primary_idvers = set(primary.by_idver)
+        rows = []
+        for session_name in self.test.secondary_names:
+            catalog = catalogs[session_name]
+            idvers = set(catalog.by_idver)
+            missing = primary_idvers - idvers
+            rows.append(['%.3f' % time(), '%.3f' % (time_requested - self.time0),
+                         self.test.sessions[session_name].server, len(primary_idvers),
+                         len(idvers), len(missing), len(idvers - primary_idvers),
+                         '%.3f' % self.oldest_age(primary, missing)])
+        self.write(rows)
+        for listener in self.listeners:
+            listener(time_requested, primary, catalogs)
+
+    def write(self, rows):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        new = not os.path.isfile(self.filename) or os.path.getsize(self.filename) == 0
+        with open(self.filename, 'ab') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(COLUMNS)
+            writer.writerows(rows)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception, e:
+                self.logger.error(u'Не удалось снять каталоги для замера отставания: %s' % e)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
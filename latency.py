@@ -0,0 +1,86 @@
+# coding: utf-8
+import csv
+import json
+import math
+
+# Верхние границы корзин гистограммы задержек, секунды
+HISTOGRAM_BOUNDS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, float('inf'))
+
+
+def percentile(values, p):
+    """Перцентиль p (0..100) методом ближайшего ранга; values должны быть отсортированы"""
+    if not values:
+        return None
+    k = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(k, 0)]
+
+
+def histogram(values, bounds=HISTOGRAM_BOUNDS):
+    """Вернуть [{'le': граница, 'count': число значений в корзине}, ...]"""
+    counts = [0] * len(bounds)
+    for value in values:
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                counts[i] += 1
+                break
+    return [{'le': 'inf' if math.isinf(bound) else bound, 'count': count}
+            for bound, count in zip(bounds, counts)]
+
+
+def summarize(values):
+    """Сводка по задержкам: count, mean, p50, p90, p99, max, histogram"""
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None,
+        'histogram': histogram(values),
+    }
+
+
+class LatencyReport(object):
+    """Задержки репликации (от действия на вышестоящем сервере до появления результата
+    на нижестоящем) по этапам теста и нижестоящим серверам:
+    phase -> {(server, (id, version)): секунды}.
+    """
+    def __init__(self):
+        self.phases = []  # этапы в порядке появления
+        self.latencies = {}
+
+    def record(self, phase, server, idver, seconds):
+        if phase not in self.latencies:
+            self.phases.append(phase)
+            self.latencies[phase] = {}
+        self.latencies[phase][(server, idver)] = seconds
+
+    def servers(self, phase):
+        return sorted(set(server for server, idver in self.latencies.get(phase, {})))
+
+    def summary(self, phase, server=None):
+        """Сводка задержек этапа phase по серверу server или по всем серверам"""
+        return summarize([seconds for (server1, idver), seconds in
+                          self.latencies.get(phase, {}).iteritems()
+                          if server is None or server1 == server])
+
+    def save(self, jsonfile, csvfile):
+        """Сохранить сводку по всем этапам (в целом и по каждому серверу) в jsonfile,
+        а сырые задержки -- в csvfile
+        """
+        report = []
+        for phase in self.phases:
+            summary = self.summary(phase)
+            summary['phase'] = phase
+            summary['servers'] = dict((server, self.summary(phase, server))
+                                      for server in self.servers(phase))
+            report.append(summary)
+        with open(jsonfile, 'w') as f:
+            json.dump(report, f, indent=2)
+        with open(csvfile, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['phase', 'server', 'id', 'version', 'seconds'])
+            for phase in self.phases:
+                for (server, (id, version)), seconds in sorted(self.latencies[phase].iteritems()):
+                    writer.writerow([phase, server, id, version, '%.3f' % seconds])
@@ -0,0 +1,466 @@
+# coding: utf-8
+import csv
+import json
+import math
+import random
+from collections import defaultdict
+from threading import Lock, Thread, Event
+from Queue import Queue
+from time import sleep
+
+import requests
+from lxml import etree
+
+from utils import monotonic, chunks
+from latency import summarize
+from lag_sampler import LagSampler
+from test import TestError
+
+# Операции нагрузки и методы LoadGenerator, которые их выполняют
+OPERATIONS = ('upload', 'metadata', 'delete')
+
+
+class LoadGenerator(object):
+    """Нагрузка на вышестоящий сервер в течение load_duration секунд: отгрузка объектов из
+    load_objects_dir, изменение метаданных и удаление уже отгруженных объектов в пропорции
+    load_mix. Режимы (load_mode):
+    - "rate" -- load_concurrency потоков выполняют операции по общему расписанию load_rate
+      операций в секунду (если потоки не успевают, расписание отстаёт);
+    - "concurrency" -- load_concurrency потоков выполняют операции без пауз.
+    Раз в lag_sample_interval секунд LagSampler снимает каталоги серверов, по которым считается
+    задержка репликации отгруженных объектов.
+    """
+    def __init__(self, test, config):
+        self.test = test
+        self.config = config
+        self.logger = test.logger
+        self.session = test.sessions['primary']
+        self.pairs = test.get_pairs(config['load_objects_dir'])
+        if not self.pairs:
+            raise TestError(u'В каталоге %s нет объектов для нагрузки' % config['load_objects_dir'])
+        self.random = random.Random(config.get('seed'))
+        self.lock = Lock()
+        self.next_pair = 0
+        self.next_slot = None
+        self.live = {}  # ID -> [(id, version), ...] отгруженные и ещё не удалённые версии
+        # имя сессии -> {(id, version): момент отгрузки} ещё не среплицировавшихся на этот сервер
+        self.pending = dict((name, {}) for name in test.secondary_names)
+        self.primary_catalog = None  # последний снимок каталога вышестоящего сервера
+        self.primary_catalog_time = None  # момент, с которого снимался этот снимок
+        self.touched = {}  # ID -> момент последнего изменения объекта нагрузкой
+        self.pair_ids = {}  # xml-файл -> ID объекта, в который он отгружался
+        self.counts = defaultdict(int)  # операция -> выполнено
+        self.errors = defaultdict(int)  # операция -> ошибок
+        self.skipped = defaultdict(int)  # операция -> пропущено (не над чем выполнять)
+        self.latencies = defaultdict(list)  # операция -> [секунды]
+        self.replication_lags = []
+        self.timeseries = []
+        self.stopped = Event()
+        self.time0 = None
+
+    # Операции. Возвращают True (успех), False (ошибка) или None (пропуск)
+    def op_upload(self):
+        with self.lock:
+            zipfile, xmlfile = self.pairs[self.next_pair % len(self.pairs)]
+            self.next_pair += 1
+            # повторная отгрузка пары -- новая версия того же объекта
+            if xmlfile in self.pair_ids:
+                self.touched[self.pair_ids[xmlfile]] = monotonic()
+        response = self.session.upload_object(zipfile, xmlfile)
+        time_uploaded = monotonic()
+        if response.status_code != 200:
+            self.logger.error(u'Не удалось отгрузить %s: %s' %
+                              (zipfile, self.test.format_error_response(response)))
+            return False
+        try:
+            obj = etree.fromstring(response.content).find('.//object')
+        except etree.XMLSyntaxError:
+            obj = None
+        if obj is None:
+            self.logger.error(u'Не удалось распарсить ответ сервера на отгрузку %s' % zipfile)
+            return False
+        idver = (obj.get('objectId'), obj.get('version'))
+        with self.lock:
+            versions = self.live.setdefault(idver[0], [])
+            # в каталоге объект есть только в последней версии: прежняя уже не появится
+            for pending in self.pending.itervalues():
+                for old_idver in versions:
+                    pending.pop(old_idver, None)
+                pending[idver] = time_uploaded
+            versions.append(idver)
+            self.touched[idver[0]] = time_uploaded
+            self.pair_ids[xmlfile] = idver[0]
+        return True
+
+    def op_metadata(self):
+        # Updated в снимке у объектов, изменённых после его снятия, устарел: сервер отклонит
+        # такое изменение как конкурирующее, поэтому они пропускаются до следующего снимка
+        with self.lock:
+            catalog, catalog_time = self.primary_catalog, self.primary_catalog_time
+            ids = [id for id in self.live if catalog is not None and catalog.find_by_id(id) and
+                   self.touched.get(id, 0) < catalog_time]
+            if not ids:
+                return None
+            id = self.random.choice(ids)
+            # чтобы другие потоки не взяли тот же объект
+            self.touched[id] = monotonic()
+        chart = catalog.find_by_id(id)
+        metadata = dict((attr, value) for attr, value in chart.iteritems() if attr.startswith('c'))
+        metadata['c122'] = u'%s нагрузка %d' % (metadata.get('c122', u''), self.counts['metadata'])
+        params = self.test.set_chart_metadata_params(
+                [{'id':id, 'updated':float(chart['Updated'])}], metadata)
+        msg = self.test.run_set_chart_metadata(params)
+        # момент ответа, а не запроса: сервер мог применить изменение уже после снятия снимка
+        with self.lock:
+            self.touched[id] = monotonic()
+        if msg is not None:
+            self.logger.error(u'Не изменены метаданные объекта с id=%s: %s' % (id, msg))
+            return False
+        return True
+
+    def op_delete(self):
+        with self.lock:
+            if not self.live:
+                return None
+            id = self.random.choice(self.live.keys())
+            idvers = self.live.pop(id)
+        response = self.session.delete_objects(idvers)
+        if response.status_code != 200:
+            self.logger.error(u'Не удалось удалить объект с id=%s: %s' %
+                              (id, self.test.format_error_response(response)))
+            with self.lock:
+                self.live[id] = idvers + self.live.get(id, [])
+            return False
+        with self.lock:
+            for pending in self.pending.itervalues():
+                for idver in idvers:
+                    pending.pop(idver, None)
+        return True
+
+    def unreplicated(self):
+        """{(id, version): момент отгрузки} объектов, не дошедших хотя бы до одного нижестоящего
+        сервера (вызывается под self.lock)
+        """
+        unreplicated = {}
+        for pending in self.pending.itervalues():
+            unreplicated.update(pending)
+        return unreplicated
+
+    def choose_operation(self):
+        mix = self.config['load_mix']
+        x = self.random.uniform(0, sum(mix.get(op, 0) for op in OPERATIONS))
+        for op in OPERATIONS:
+            x -= mix.get(op, 0)
+            if x <= 0 and mix.get(op, 0):
+                return op
+        return 'upload'
+
+    def take_slot(self):
+        """Момент, в который потоку выполнять следующую операцию (режим rate)"""
+        with self.lock:
+            slot = self.next_slot
+            self.next_slot += 1.0 / self.config['load_rate']
+        return slot
+
+    def worker(self, deadline):
+        while not self.stopped.is_set():
+            if self.config['load_mode'] == 'rate':
+                slot = self.take_slot()
+                if slot >= deadline:
+                    break
+                delay = slot - monotonic()
+                if delay > 0:
+                    sleep(delay)
+            elif monotonic() >= deadline:
+                break
+            with self.lock:
+                op = self.choose_operation()
+            time0 = monotonic()
+            try:
+                ok = getattr(self, 'op_%s' % op)()
+            except (requests.RequestException, TestError), e:
+                self.logger.error(u'Ошибка операции %s: %s' % (op, e))
+                ok = False
+            seconds = monotonic() - time0
+            with self.lock:
+                if ok is None:
+                    self.skipped[op] += 1
+                    continue
+                self.counts[op] += 1
+                self.latencies[op].append(seconds)
+                if not ok:
+                    self.errors[op] += 1
+
+    def on_sample(self, time_requested, primary, catalogs):
+        """Обработчик замера LagSampler: учесть среплицировавшиеся объекты и добавить точку
+        временного ряда
+        """
+        with self.lock:
+            self.primary_catalog, self.primary_catalog_time = primary, time_requested
+            for session_name, pending in self.pending.iteritems():
+                catalog = catalogs[session_name]
+                for idver, time_uploaded in pending.items():
+                    if catalog.find(*idver) is not None:
+                        self.replication_lags.append(time_requested - time_uploaded)
+                        del pending[idver]
+            unreplicated = self.unreplicated()
+            oldest = min(unreplicated.itervalues()) if unreplicated else None
+            row = {'elapsed': time_requested - self.time0,
+                   'pending': len(unreplicated),
+                   'oldest_pending_age': time_requested - oldest if oldest is not None else 0}
+            for op in OPERATIONS:
+                row[op] = self.counts[op]
+                row['%s_errors' % op] = self.errors[op]
+            self.timeseries.append(row)
+        self.logger.info(u'%.0f сек.: отгружено %d, метаданных %d, удалено %d, ошибок %d, '
+                         u'не среплицировано %d (старейшему %.1f сек.)' %
+                         (row['elapsed'], row['upload'], row['metadata'], row['delete'],
+                          sum(self.errors.values()), row['pending'], row['oldest_pending_age']))
+
+    def run(self):
+        """Дать нагрузку, дождаться репликации (не дольше drain_timeout) и сохранить результаты.
+        Отставание всех нижестоящих серверов пишется в results_dir/replication_lag.csv
+        (см. LagSampler).
+        """
+        duration = self.config['load_duration']
+        concurrency = self.config['load_concurrency']
+        self.logger.info(u'Нагрузка %s: %s потоков, %s сек.' % (
+            u'%s оп./с' % self.config['load_rate'] if self.config['load_mode'] == 'rate'
+            else u'без пауз', concurrency, duration))
+        self.time0 = monotonic()
+        self.next_slot = self.time0
+        deadline = self.time0 + duration
+        sampler = LagSampler(self.test, self.config['lag_sample_interval'],
+                             '%s/replication_lag.csv' % self.config['results_dir'],
+                             [self.on_sample])
+        sampler.sample()
+        sampler.start()
+        workers = [Thread(target=self.worker, args=(deadline,)) for _ in xrange(concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(1)
+            self.elapsed = monotonic() - self.time0
+            drain_deadline = monotonic() + self.config['drain_timeout']
+            while any(self.pending.itervalues()) and monotonic() < drain_deadline:
+                sleep(self.config['lag_sample_interval'])
+        finally:
+            self.stopped.set()
+            sampler.stop()
+        sampler.sample()
+        for session_name, pending in sorted(self.pending.iteritems()):
+            if pending:
+                self.logger.error(u'За %d сек. после нагрузки не среплицировались на %s объекты: %s'
+                                  % (self.config['drain_timeout'],
+                                     self.test.sessions[session_name].server, sorted(pending)))
+        self.save()
+
+    def summary(self):
+        elapsed = getattr(self, 'elapsed', None) or monotonic() - self.time0
+        summary = {'duration': elapsed, 'operations': {}}
+        for op in OPERATIONS:
+            op_summary = summarize(self.latencies[op])
+            op_summary['errors'] = self.errors[op]
+            op_summary['skipped'] = self.skipped[op]
+            op_summary['throughput'] = (self.counts[op] - self.errors[op]) / elapsed
+            op_summary['error_rate'] = (float(self.errors[op]) / self.counts[op]
+                                        if self.counts[op] else 0)
+            summary['operations'][op] = op_summary
+        summary['replication_lag'] = summarize(self.replication_lags)
+        with self.lock:
+            summary['unreplicated'] = len(self.unreplicated())
+        return summary
+
+    def save(self):
+        """Сохранить сводку в results_dir/load.json и временной ряд в results_dir/load.csv"""
+        summary = self.summary()
+        with open('%s/load.json' % self.config['results_dir'], 'w') as f:
+            json.dump(summary, f, indent=2)
+        columns = ['elapsed', 'pending', 'oldest_pending_age']
+        for op in OPERATIONS:
+            columns += [op, '%s_errors' % op]
+        with open('%s/load.csv' % self.config['results_dir'], 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in self.timeseries:
+                writer.writerow([('%.3f' % row[column]) if isinstance(row[column], float)
+                                 else row[column] for column in columns])
+        for op in OPERATIONS:
+            s = summary['operations'][op]
+            if s['count']:
+                self.logger.info(u'%s: %d операций (%.2f/с), ошибок %.1f%%, p50=%.2f p90=%.2f '
+                                 u'p99=%.2f сек.' % (op, s['count'], s['throughput'],
+                                                     s['error_rate'] * 100, s['p50'], s['p90'],
+                                                     s['p99']))
+        lag = summary['replication_lag']
+        if lag['count']:
+            self.logger.info(u'Задержка репликации (%d реплик): p50=%.1f p90=%.1f p99=%.1f '
+                             u'max=%.1f сек.' % (lag['count'], lag['p50'], lag['p90'], lag['p99'],
+                                                 lag['max']))
+
+    def cleanup(self):
+        """Удалить с вышестоящего сервера все оставшиеся отгруженные объекты"""
+        with self.lock:
+            idvers = [idver for versions in self.live.itervalues() for idver in versions]
+            self.live = {}
+        batches = [('primary', batch) for batch in
+                   chunks(idvers, self.config.get('delete_batch_size', 1))]
+        failures = self.test.run_deletion_plan(batches)
+        if failures:
+            raise TestError(u'Не удалось удалить объектов: %d' % len(failures))
+
+
+def arrival_offsets(rate, duration, poisson=False, rng=random):
+    """Моменты отправки запросов (секунды от начала) при rate запросах в секунду в течение
+    duration секунд: через равные промежутки или пуассоновским потоком (экспоненциальные
+    промежутки со средним 1/rate).
+    """
+    if not poisson:
+        for i in xrange(int(math.ceil(rate * duration))):
+            yield i / float(rate)
+        return
+    offset = rng.expovariate(rate)
+    while offset < duration:
+        yield offset
+        offset += rng.expovariate(rate)
+
+
+class OpenLoopSweep(object):
+    """Отгрузка объектов из load_objects_dir с открытым циклом: запросы PutObject отправляются
+    по расписанию (open_loop_arrivals: "fixed" или "poisson") с интенсивностью rate, не дожидаясь
+    ответов на предыдущие, и задержка считается от запланированного момента отправки, так что
+    очередь на сервере не прячется за паузами клиента. Для каждой интенсивности из
+    open_loop_rates этап длится open_loop_step_duration секунд, а репликация отслеживается
+    Test.track_uploads одновременно с отгрузкой. Свод по этапам сохраняется в
+    results_dir/open_loop.json. Перебор прекращается на первой интенсивности, при которой
+    нижестоящие серверы не догнали вышестоящий.
+    Каждый объект отгружается один раз: набор данных должен быть достаточно большим
+    (см. generate_dataset.py).
+    """
+    def __init__(self, test, config):
+        self.test = test
+        self.config = config
+        self.logger = test.logger
+        self.pairs = iter(test.get_pairs(config['load_objects_dir']))
+        self.random = random.Random(config.get('seed'))
+        self.lock = Lock()
+        self.results = []
+
+    def put(self, rate, uploaded_queue, stats):
+        """Отгружать объекты с интенсивностью rate (см. Test.track_uploads)"""
+        session = self.test.sessions['primary']
+        requests_queue = Queue()
+
+        def worker():
+            while True:
+                item = requests_queue.get()
+                if item is None:
+                    return
+                time_intended, zipfile, xmlfile = item
+                time_sent = monotonic()
+                try:
+                    response = session.upload_object(zipfile, xmlfile)
+                    time_uploaded = monotonic()
+                    id, version = self.test.handle_upload_response(response, zipfile, xmlfile)
+                except (requests.RequestException, TestError), e:
+                    time_uploaded = monotonic()
+                    if unicode(e):
+                        self.logger.error(u'Не удалось отгрузить %s: %s' % (zipfile, e))
+                    id = None
+                with self.lock:
+                    stats['latencies'].append(time_uploaded - time_intended)
+                    stats['send_delays'].append(time_sent - time_intended)
+                    if id is None:
+                        stats['errors'] += 1
+                if id is not None:
+                    self.test.action_times[(id, version)] = time_uploaded
+                    uploaded_queue.put((id, version, time_uploaded))
+
+        workers = [Thread(target=worker) for _ in xrange(self.config['open_loop_workers'])]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        time0 = monotonic()
+        try:
+            for offset in arrival_offsets(rate, self.config['open_loop_step_duration'],
+                                          self.config['open_loop_arrivals'] == 'poisson',
+                                          self.random):
+                try:
+                    zipfile, xmlfile = next(self.pairs)
+                except StopIteration:
+                    self.logger.warn(u'Объекты в каталоге %s закончились, этап прерван' %
+                                     self.config['load_objects_dir'])
+                    break
+                delay = time0 + offset - monotonic()
+                if delay > 0:
+                    sleep(delay)
+                requests_queue.put((time0 + offset, zipfile, xmlfile))
+                stats['scheduled'] += 1
+        finally:
+            for thread in workers:
+                requests_queue.put(None)
+            for thread in workers:
+                thread.join()
+            stats['elapsed'] = monotonic() - time0
+            uploaded_queue.put(None)
+
+    def run_step(self, rate):
+        """Этап с интенсивностью rate; возвращает свод по этапу"""
+        phase = 'open_loop_%g' % rate
+        stats = {'scheduled': 0, 'errors': 0, 'latencies': [], 'send_delays': []}
+        self.logger.info(u'Отгружаю объекты с интенсивностью %g/с (%s) в течение %s сек.' %
+                         (rate, self.config['open_loop_arrivals'],
+                          self.config['open_loop_step_duration']))
+        converged = self.test.track_uploads(
+                lambda uploaded_queue: self.put(rate, uploaded_queue, stats), phase)
+        completed = len(stats['latencies'])
+        result = {
+            'rate': rate,
+            'scheduled': stats['scheduled'],
+            'completed': completed,
+            'errors': stats['errors'],
+            'throughput': (completed - stats['errors']) / stats['elapsed'],
+            'latency': summarize(stats['latencies']),
+            'send_delay': summarize(stats['send_delays']),
+            'replication_lag': self.test.latency.summary(phase),
+            'converged': converged,
+        }
+        latency, lag = result['latency'], result['replication_lag']
+        self.logger.info(u'%g/с: отгружено %d из %d (ошибок %d, %.2f/с), задержка отгрузки '
+                         u'p50=%.2f p99=%.2f сек.' %
+                         (rate, completed - stats['errors'], stats['scheduled'], stats['errors'],
+                          result['throughput'], latency['p50'] or 0, latency['p99'] or 0))
+        if lag['count']:
+            self.logger.info(u'%g/с: задержка репликации p50=%.1f p99=%.1f max=%.1f сек.' %
+                             (rate, lag['p50'], lag['p99'], lag['max']))
+        if result['send_delay']['max'] > 1.0:
+            self.logger.warn(u'%g/с: запросы отправлялись с опозданием до %.1f сек., '
+                             u'увеличьте open_loop_workers' % (rate, result['send_delay']['max']))
+        return result
+
+    def run(self):
+        """Пройти по интенсивностям; отставание нижестоящих серверов на протяжении всего
+        перебора пишется в results_dir/replication_lag.csv (см. LagSampler)
+        """
+        sampler = LagSampler(self.test, self.config['lag_sample_interval'],
+                             '%s/replication_lag.csv' % self.config['results_dir'])
+        sampler.start()
+        try:
+            for rate in self.config['open_loop_rates']:
+                result = self.run_step(rate)
+                self.results.append(result)
+                self.save()
+                if not result['converged']:
+                    self.logger.error(u'При %g/с нижестоящие серверы не догнали вышестоящий' % rate)
+                    break
+                self.test.check_replicated_objects()
+                self.test.backup_and_clear_uploaded_objects()
+        finally:
+            sampler.stop()
+
+    def save(self):
+        with open('%s/open_loop.json' % self.config['results_dir'], 'w') as f:
+            json.dump(self.results, f, indent=2)
@@ -0,0 +1,547 @@
+# coding: utf-8
+"""Локальная замена пары серверов (cdserver) для отладки и измерения самого тестового стенда.
+Реализует то, чем пользуются Session и Test: /login, /api/easo/PutObject, GetCatalog,
+GetArchiveCatalog, DeleteObjects, /jsonrpc/admin.* и /webapi (set_chart_metadata,
+system.multicall). Изменения на вышестоящем экземпляре реплицируются на нижестоящий
+(в том же процессе) с задержкой delay ± jitter секунд; доля failure_rate изменений теряется.
+
+python mock_server.py -- поднять пару primary_port -> secondary_port (см. _config) и ждать Ctrl+C.
+В конфигурации теста тогда "primary_server": "127.0.0.1:8001", "secondary_server": "127.0.0.1:8002".
+"""
+import os
+import cgi
+import socket
+import json
+import heapq
+import random
+import xmlrpclib
+from uuid import uuid4
+from time import time, sleep
+from zipfile import ZipFile, ZIP_DEFLATED
+from cStringIO import StringIO
+from Cookie import SimpleCookie
+from threading import Condition, Lock, Thread
+from urlparse import parse_qs
+from xml.sax.saxutils import quoteattr
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from lxml import etree
+
+from utils import get_logger
+
+
+_config = {
+    "host": "127.0.0.1",
+    "primary_port": 8001,
+    "secondary_port": 8002,
+    "login": "user1",
+    "password": "12345678",
+    # "stream" -- потоковая репликация; "manual" -- изменения копятся до запуска корректирующей
+    # репликации (admin.start_replications) или задачи "ВыгрузкаФайлов" (admin.run_script)
+    "replication": "stream",
+    "delay": 2,
+    "jitter": 1,
+    "failure_rate": 0,
+    "http_error_rate": 0,  # доля запросов к /api/easo, на которые отвечается 503
+    "replicant_name": "secondarybnd",
+    "md_version": "1",
+    "seed": None,
+    "loglevel": "INFO"
+}
+
+# Задача "ВыгрузкаФайлов" (см. Test.offload_files)
+OFFLOAD_SCRIPT_ID = 16
+
+
+class MockStore(object):
+    """Каталог одного экземпляра сервера.
+    Объект -- список версий (словарей атрибутов CHART), последняя версия -- текущая.
+    Для каталога изменений (GetCatalog from=...) помнится момент последнего изменения каждого
+    объекта.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.objects = {}  # ID -> [версия, ...]
+        self.by_name = {}  # (Name, Class) -> ID
+        self.changed = {}  # ID -> момент последнего изменения
+        self.next_id = 100001
+        self.last_time = 0
+        self.listener = None  # listener(операция, аргументы) -- для репликации
+
+    def now(self):
+        """Строго возрастающие моменты изменений (вызывается под self.lock)"""
+        self.last_time = max(time(), self.last_time + 1e-6)
+        return self.last_time
+
+    def touch(self, id):
+        self.changed[id] = self.now()
+
+    def notify(self, op, *args):
+        if self.listener is not None:
+            self.listener(op, args)
+
+    def put(self, attrs):
+        """Поместить объект; версия объекта с теми же Name и Class становится новой версией.
+        Возвращает (ID, Issue).
+        """
+        with self.lock:
+            key = (attrs['Name'], attrs['Class'])
+            id = self.by_name.get(key)
+            if id is None:
+                id = str(self.next_id)
+                self.next_id += 1
+                self.objects[id] = []
+                self.by_name[key] = id
+            version = dict(attrs)
+            version['ID'] = id
+            version['Issue'] = str(len(self.objects[id]) + 1)
+            self.touch(id)
+            version['Updated'] = '%.6f' % self.changed[id]
+            self.objects[id].append(version)
+        self.notify('put', dict(version))
+        return id, version['Issue']
+
+    def put_version(self, version):
+        """Поместить готовую версию (с ID и Issue) -- так применяется репликация"""
+        with self.lock:
+            id = version['ID']
+            versions = self.objects.setdefault(id, [])
+            versions[:] = [v for v in versions if v['Issue'] != version['Issue']] + [version]
+            self.by_name[(version['Name'], version['Class'])] = id
+            self.touch(id)
+
+    def delete(self, idvers):
+        """Удалить версии [(ID, Issue), ...]; все или ни одной.
+        Возвращает None или сообщение об ошибке.
+        """
+        with self.lock:
+            for id, issue in idvers:
+                if not any(v['Issue'] == issue for v in self.objects.get(id, [])):
+                    return u'Не найдена версия %s объекта %s' % (issue, id)
+            for id, issue in idvers:
+                versions = self.objects[id]
+                current = versions[-1]
+                versions[:] = [v for v in versions if v['Issue'] != issue]
+                if versions:
+                    if versions[-1] is not current:
+                        self.touch(id)
+                else:
+                    del self.objects[id]
+                    # имя уже могло перейти к новому объекту (на реплике изменения разных
+                    # объектов применяются не по порядку)
+                    key = (current['Name'], current['Class'])
+                    if self.by_name.get(key) == id:
+                        del self.by_name[key]
+                    self.changed.pop(id, None)
+        for id, issue in idvers:
+            self.notify('delete', id, issue)
+        return None
+
+    def set_metadata(self, id, md_item, updated=None):
+        """Заменить атрибуты метаданных текущей версии объекта.
+        updated -- Updated, который видел клиент; если объект с тех пор изменился, то ошибка.
+        Возвращает None или сообщение об ошибке.
+        """
+        with self.lock:
+            versions = self.objects.get(id)
+            if not versions:
+                return u'Не найден объект %s' % id
+            if updated is not None and abs(float(versions[-1]['Updated']) - updated) > 1e-3:
+                return u'Объект %s изменён другим пользователем' % id
+            version = dict(versions[-1])
+            for attr, value in md_item.iteritems():
+                if not isinstance(value, basestring):
+                    value = unicode(value)
+                version[attr] = value
+            self.touch(id)
+            version['Updated'] = '%.6f' % self.changed[id]
+            versions[-1] = version
+        self.notify('metadata', id, dict(md_item))
+        return None
+
+    def apply(self, op, args):
+        """Применить реплицированное изменение"""
+        if op == 'put':
+            self.put_version(args[0])
+        elif op == 'delete':
+            self.delete([args])
+        elif op == 'metadata':
+            self.set_metadata(*args)
+
+    def catalog_xml(self, since=0):
+        """Каталог (WF.CLL): текущие версии объектов, изменённых после since"""
+        with self.lock:
+            created = self.now()
+            charts = [self.objects[id][-1] for id, changed in self.changed.iteritems()
+                      if changed > since]
+        lines = ['<?xml version="1.0" encoding="utf-8"?>\n<CATALOG Created="%.6f">\n' % created]
+        for chart in charts:
+            lines.append(chart_xml(chart))
+        lines.append('</CATALOG>\n')
+        return ''.join(lines)
+
+    def archive_catalog_xml(self, id):
+        """Архивный каталог объекта: все версии, кроме текущей"""
+        with self.lock:
+            versions = list(self.objects.get(id, [])[:-1])
+        return ('<?xml version="1.0" encoding="utf-8"?>\n<CATALOG>\n%s</CATALOG>\n' %
+                ''.join(chart_xml(version) for version in versions))
+
+
+def chart_xml(chart):
+    return '<CHART %s/>\n' % ' '.join('%s=%s' % (attr, quoteattr(value).encode('utf-8')
+                                                 if isinstance(value, unicode) else quoteattr(value))
+                                      for attr, value in sorted(chart.iteritems()))
+
+
+def zip_bytes(filename, content):
+    buf = StringIO()
+    with ZipFile(buf, 'w', ZIP_DEFLATED) as zf:
+        zf.writestr(filename, content)
+    return buf.getvalue()
+
+
+class Replicator(Thread):
+    """Применяет изменения вышестоящего экземпляра к хранилищу target через delay ± jitter
+    секунд. Изменения одного объекта применяются в порядке их появления. С вероятностью
+    failure_rate изменение теряется. В режиме stream=False изменения копятся до release().
+    """
+    def __init__(self, target, delay, jitter, failure_rate=0, stream=True, seed=None, logger=None):
+        super(Replicator, self).__init__()
+        self.daemon = True
+        self.target = target
+        self.delay = delay
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.stream = stream
+        self.random = random.Random(seed)
+        self.logger = logger
+        self.condition = Condition()
+        self.queue = []  # куча (момент применения, номер, операция, аргументы)
+        self.held = []  # изменения, ждущие release() (stream=False)
+        self.last_due = {}  # ID -> момент применения последнего изменения объекта
+        self.counter = 0
+        self.lost = 0
+        self.stopped = False
+
+    def submit(self, op, args):
+        with self.condition:
+            if self.stream:
+                self.schedule(op, args)
+            else:
+                self.held.append((op, args))
+
+    def release(self):
+        """Начать репликацию накопленных изменений"""
+        with self.condition:
+            held, self.held = self.held, []
+            for op, args in held:
+                self.schedule(op, args)
+
+    def schedule(self, op, args):
+        """Поставить изменение в очередь (вызывается под self.condition)"""
+        if self.random.random() < self.failure_rate:
+            self.lost += 1
+            if self.logger is not None:
+                self.logger.warn(u'Потеряно изменение %s %s' % (op, args[0].get('ID')
+                                 if isinstance(args[0], dict) else args[0]))
+            return
+        id = args[0]['ID'] if op == 'put' else args[0]
+        due = time() + max(0, self.delay + self.random.uniform(-self.jitter, self.jitter))
+        due = max(due, self.last_due.get(id, 0))
+        self.last_due[id] = due
+        self.counter += 1
+        heapq.heappush(self.queue, (due, self.counter, op, args))
+        self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.queue or self.queue[0][0] > time()):
+                    self.condition.wait(self.queue[0][0] - time() if self.queue else None)
+                if self.stopped:
+                    return
+                due, counter, op, args = heapq.heappop(self.queue)
+            self.target.apply(op, args)
+
+    def stop(self):
+        """Остановить поток; неприменённые изменения отбрасываются"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.join()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, как у настоящего сервера
+
+    def log_message(self, format, *args):
+        if self.server.logger is not None:
+            self.server.logger.debug(u'%s: %s' % (self.server.name, format % args))
+
+    def send(self, code, content='', content_type='text/xml', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_result(self, code, message=u'', extra=''):
+        content = ('<?xml version="1.0" encoding="utf-8"?>\n<response><result result_code="%d" '
+                   'result_message=%s/>%s</response>' %
+                   (0 if code == 200 else code, quoteattr(message).encode('utf-8'), extra))
+        self.send(code, content)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def get_cookies(self):
+        cookies = SimpleCookie(self.headers.get('Cookie', ''))
+        return dict((name, morsel.value) for name, morsel in cookies.iteritems())
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/login':
+            self.send(404)
+            return
+        csrftoken = uuid4().hex
+        self.send(200, '<html/>', 'text/html',
+                  [('Set-Cookie', 'csrftoken=%s; Path=/' % csrftoken)])
+
+    def do_POST(self):
+        server = self.server
+        if self.path.rstrip('/') == '/login':
+            form = parse_qs(self.read_body())
+            if (form.get('login') != [server.login] or form.get('password') != [server.password]):
+                self.send(200, '<html>login failed</html>', 'text/html')
+                return
+            sessionid = uuid4().hex
+            with server.lock:
+                server.sessions.add(sessionid)
+            self.send(200, '<html/>', 'text/html', [('Set-Cookie', 'sessionid=%s; Path=/' % sessionid)])
+            return
+
+        # X-CSRFToken проверяется только у /api/easo: jsonrpc и webapi Session шлёт без него
+        cookies = self.get_cookies()
+        if (cookies.get('sessionid') not in server.sessions or
+                (self.path.startswith('/api/easo/') and
+                 self.headers.get('X-CSRFToken') != cookies.get('csrftoken'))):
+            self.read_body()
+            self.send_result(403, u'Требуется вход')
+            return
+
+        if self.path.startswith('/api/easo/'):
+            if server.random.random() < server.http_error_rate:
+                self.read_body()
+                self.send_result(503, u'Сервер перегружен (имитация)')
+                return
+            method = self.path[len('/api/easo/'):]
+            handler = getattr(self, 'api_%s' % method, None)
+            if handler is None:
+                self.read_body()
+                self.send_result(404, u'Неизвестный метод %s' % method)
+            else:
+                handler()
+        elif self.path.startswith('/jsonrpc/'):
+            self.jsonrpc(self.path[len('/jsonrpc/'):], parse_qs(self.read_body()))
+        elif self.path.rstrip('/') == '/webapi':
+            self.xmlrpc(self.read_body())
+        else:
+            self.read_body()
+            self.send(404)
+
+    def api_PutObject(self):
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD':'POST',
+                                         'CONTENT_TYPE':self.headers['Content-Type']})
+        try:
+            chart_tree = etree.fromstring(form['object_attrs'].value)
+            object_file = form['object_file'].file
+        except (KeyError, etree.XMLSyntaxError):
+            self.send_result(400, u'Нет полей object_attrs и object_file')
+            return
+        # содержимое архива не хранится, но читается целиком, как настоящим сервером
+        while object_file.read(64 * 1024):
+            pass
+        chart = chart_tree.find('.//chart')
+        attrs = {'Name':chart.get('Name'), 'Class':chart.get('Class'), 'Type':chart.get('Type')}
+        for attribute in chart_tree.findall('.//Attribute'):
+            attrs[attribute.get('name')] = attribute.get('value')
+        id, issue = self.server.store.put(attrs)
+        self.send_result(200, extra='<object objectId="%s" version="%s"/>' % (id, issue))
+
+    def api_GetCatalog(self):
+        request = etree.fromstring(self.read_body())
+        since = float(request.find('.//getCatalog').get('from') or 0)
+        self.send(200, zip_bytes('WF.CLL', self.server.store.catalog_xml(since)),
+                  'application/zip')
+
+    def api_GetArchiveCatalog(self):
+        request = etree.fromstring(self.read_body())
+        id = request.find('.//object').get('object_id')
+        self.send(200, zip_bytes('catalog.xml', self.server.store.archive_catalog_xml(id)),
+                  'application/zip')
+
+    def api_DeleteObjects(self):
+        request = etree.fromstring(self.read_body())
+        idvers = [(v.get('objectId'), v.get('versionNumber'))
+                  for v in request.findall('.//deleteVersion')]
+        msg = self.server.store.delete(idvers)
+        if msg is None:
+            self.send_result(200)
+        else:
+            self.send_result(404, msg)
+
+    def jsonrpc(self, method, data):
+        server = self.server
+        result = {'success':True}
+        if method == 'admin.md_classifier_version':
+            result['md_version'] = server.md_version
+        elif method == 'admin.get_list_db':
+            result['rows'] = [{'username':name, 'replicantId':i + 1}
+                              for i, name in enumerate(server.replicants)]
+        elif method == 'admin.start_replications' or (
+                method == 'admin.run_script' and data.get('script_id') == [str(OFFLOAD_SCRIPT_ID)]):
+            if server.replicator is not None:
+                server.replicator.release()
+        elif method == 'admin.run_script':
+            pass
+        else:
+            result = {'success':False, 'msg':u'Неизвестный метод %s' % method}
+        self.send(200, json.dumps(result), 'application/json')
+
+    def xmlrpc(self, body):
+        try:
+            params, methodname = xmlrpclib.loads(body)
+            if methodname == 'system.multicall':
+                result = []
+                for call in params[0]:
+                    try:
+                        result.append([self.xmlrpc_call(call['methodName'], call['params'])])
+                    except xmlrpclib.Fault, e:
+                        result.append({'faultCode':e.faultCode, 'faultString':e.faultString})
+            else:
+                result = self.xmlrpc_call(methodname, params)
+            response = xmlrpclib.dumps((result,), methodresponse=True, allow_none=True,
+                                       encoding='utf-8')
+        except xmlrpclib.Fault, e:
+            response = xmlrpclib.dumps(e, methodresponse=True)
+        self.send(200, response)
+
+    def xmlrpc_call(self, methodname, params):
+        if methodname != 'set_chart_metadata':
+            raise xmlrpclib.Fault(1, 'Unknown method %s' % methodname)
+        session_id, md_version, chart_ids, md_item, tags = params
+        if md_version != self.server.md_version:
+            return {'success':False, 'msg':u'Версия классификатора не совпадает'}
+        # chart_ids -- [{'id': ID, 'updated': Updated}, ...] (см. Test.change_metadata)
+        errors = [self.server.store.set_metadata(chart['id'], md_item, chart.get('updated'))
+                  for chart in chart_ids]
+        errors = [msg for msg in errors if msg is not None]
+        if errors:
+            return {'success':False, 'msg':u'; '.join(errors)}
+        return {'success':True}
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """Один экземпляр сервера. Обслуживается в фоновом потоке (см. start)."""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, name, address, config, logger=None):
+        HTTPServer.__init__(self, address, MockHandler)
+        self.name = name
+        self.logger = logger
+        self.login = config['login']
+        self.password = config['password']
+        self.md_version = config['md_version']
+        self.replicants = [config['replicant_name']]
+        self.http_error_rate = config.get('http_error_rate', 0)
+        self.random = random.Random(config.get('seed'))
+        self.lock = Lock()
+        self.sessions = set()
+        self.store = MockStore()
+        self.replicator = None
+        self.requests = {}  # открытые соединения -> обслуживающие их потоки
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def replicate_to(self, other, config):
+        """Реплицировать изменения этого экземпляра на экземпляр other"""
+        self.replicator = Replicator(other.store, config['delay'], config['jitter'],
+                                     config.get('failure_rate', 0),
+                                     stream=config.get('replication', 'stream') == 'stream',
+                                     seed=config.get('seed'), logger=self.logger)
+        self.store.listener = self.replicator.submit
+        self.replicator.start()
+
+    def process_request(self, request, client_address):
+        # как в ThreadingMixIn, но потоки запоминаются, чтобы stop() мог их дождаться
+        thread = Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = self.daemon_threads
+        with self.lock:
+            self.requests[request] = thread
+        thread.start()
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.requests.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Остановить приём запросов, закрыть keep-alive соединения и дождаться всех потоков
+        экземпляра. Без этого фоновые потоки доживают до завершения интерпретатора и падают.
+        """
+        self.shutdown()
+        self.server_close()
+        if self.replicator is not None:
+            self.replicator.stop()
+        with self.lock:
+            requests = self.requests.items()
+        for request, thread in requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for request, thread in requests:
+            thread.join()
+
+
+def start_pair(config, logger=None, primary_port=0, secondary_port=0):
+    """Поднять пару primary -> secondary в фоновых потоках; вернуть (primary, secondary).
+    Порт 0 -- любой свободный.
+    """
+    primary = MockServer('primary', (config['host'], primary_port), config, logger)
+    secondary = MockServer('secondary', (config['host'], secondary_port), config, logger)
+    primary.replicate_to(secondary, config)
+    return primary.start(), secondary.start()
+
+
+def stop_pair(primary, secondary):
+    """Остановить пару, поднятую start_pair"""
+    primary.stop()
+    secondary.stop()
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    logger = get_logger('colorlog', _config['loglevel'], logfile='mock_server.log')
+    primary, secondary = start_pair(_config, logger, _config['primary_port'],
+                                    _config['secondary_port'])
+    logger.info(u'Вышестоящий сервер: %s, нижестоящий: %s' % (primary.address, secondary.address))
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        stop_pair(primary, secondary)
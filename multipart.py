@@ -0,0 +1,69 @@
+# coding: utf-8
+import os
+from uuid import uuid4
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartFileStream(object):
+    """Тело запроса multipart/form-data, значения полей которого читаются из файлов
+    порциями по CHUNK_SIZE байт. Длина тела известна заранее, поэтому requests отправляет его
+    с Content-Length, читая через read(), и в памяти никогда не бывает больше одной порции.
+    Файлы открываются по мере отправки и закрываются сразу после неё либо в close().
+    """
+    def __init__(self, fields):
+        """fields -- список (имя поля, путь к файлу, имя файла); если имя файла None,
+        то содержимое файла отправляется как обычное значение поля.
+        """
+        self.boundary = uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.parts = []  # (заголовок части, путь к файлу)
+        for name, path, filename in fields:
+            header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (self.boundary, name)
+            if filename is not None:
+                header += '; filename="%s"' % filename
+            header += '\r\n\r\n'
+            self.parts.append((header, path))
+        self.tail = '--%s--\r\n' % self.boundary
+        self.length = len(self.tail)
+        for header, path in self.parts:
+            self.length += len(header) + os.path.getsize(path) + len('\r\n')
+        self._chunks = self._iter_chunks()
+        self._buffer = ''
+
+    def _iter_chunks(self):
+        for header, path in self.parts:
+            yield header
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield '\r\n'
+        yield self.tail
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        if self._buffer:
+            yield self._buffer
+            self._buffer = ''
+        for chunk in self._chunks:
+            yield chunk
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """Закрыть недочитанный файл, если отправка прервалась"""
+        self._chunks.close()
@@ -0,0 +1,85 @@
+# coding: utf-8
+"""Прогон одного сценария на нескольких парах серверов в одном процессе (см. PairsTestDriver).
+Асинхронного интерфейса (asyncio-варианта Session и Test) здесь нет: в Python 2 нет asyncio,
+поэтому каждая пара прогоняется обычным блокирующим Test в своём потоке пула.
+"""
+import os
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from utils import get_logger
+from test import Test, TestError
+
+
+class PairsTestDriver(object):
+    """Прогон одного сценария одновременно на нескольких парах серверов в одном процессе.
+    config -- общая конфигурация (как в скриптах test_*.py);
+    pairs -- [(primary_server, secondary_server), ...].
+    Для каждой пары создаётся свой Test со своим логгером и каталогом результатов
+    results_dir/<primary>_<secondary>; каталоги с данными для отгрузки общие.
+    Пары прогоняются в пуле потоков, по потоку на пару.
+    """
+    def __init__(self, config, pairs, logger):
+        self.config = config
+        self.pairs = pairs
+        self.logger = logger
+
+    def make_test(self, pair):
+        primary_server, secondary_server = pair
+        config = dict(self.config)
+        config['primary_server'] = primary_server
+        config['secondary_servers'] = [secondary_server]
+        config['results_dir'] = '%s/%s_%s' % (self.config['results_dir'],
+                                              primary_server, secondary_server)
+        if not os.path.isdir(config['results_dir']):
+            os.makedirs(config['results_dir'])
+        if config.get('upload_cache_file'):
+            # манифест отгрузок у каждой пары свой, чтобы пары не перезаписывали файл друг друга
+            config['upload_cache_file'] = '%s/%s' % (config['results_dir'],
+                                                     os.path.basename(config['upload_cache_file']))
+        logger = get_logger('pair.%s_%s' % pair, config['loglevel'],
+                            logfile='%s/log.log' % config['results_dir'],
+                            prefix='%s->%s: ' % pair)
+        return Test(config, logger)
+
+    def run_pair(self, pair, scenario):
+        """Вернуть None, если сценарий на паре pair прошёл, иначе исключение"""
+        test = None
+        try:
+            test = self.make_test(pair)
+            scenario(test)
+        except Exception, e:
+            if test is None:
+                self.logger.error(u'Не удалось подключиться к паре %s->%s' % pair)
+                self.logger.error(traceback.format_exc().decode('utf-8'))
+                return e
+            if isinstance(e, TestError):
+                test.logger.critical(u'Ошибка теста')
+                if e.message:
+                    test.logger.critical(e.message)
+            else:
+                test.logger.critical(u'Произошла непредвиденная ошибка!')
+                test.logger.critical(traceback.format_exc().decode('utf-8'))
+            if self.config['delete_objects_on_error']:
+                test.logger.info(u'Удаляю все загруженные объекты')
+                try:
+                    test.delete_uploaded_objects(error=True)
+                except Exception:
+                    test.logger.error(traceback.format_exc().decode('utf-8'))
+            test.logger.critical(u'Тест провален')
+            return e
+        test.log_sessions_stats()
+        test.logger.info_ok(u'Тест успешно пройден!')
+        return None
+
+    def run(self, scenario):
+        """Выполнить scenario(test) на всех парах одновременно.
+        Возвращает {пара: None или исключение}.
+        """
+        pool = ThreadPool(len(self.pairs))
+        try:
+            results = pool.map(lambda pair: self.run_pair(pair, scenario), self.pairs)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(self.pairs, results))
@@ -1,30 +1,222 @@
 # coding: utf-8
+import os
+import json
 from uuid import uuid4
+from time import time, sleep
+from collections import defaultdict
+from threading import Lock
 import xmlrpclib
+from xml.parsers.expat import ExpatError
+from urlparse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import create_cookie
+
+from multipart import MultipartFileStream
+
+
+# jsonrpc-методы, которые ничего не меняют на сервере и которые можно безопасно повторять
+JSONRPC_READ_METHODS = frozenset(['admin.get_list_db', 'admin.md_classifier_version'])
+# Коды ответа, при которых идемпотентный запрос повторяется
+RETRY_STATUS_CODES = frozenset([502, 503, 504])
+# Коды ответа, при которых сессия из кэша считается недействительной и выполняется вход
+AUTH_ERROR_STATUS_CODES = frozenset([401, 403])
+# Читающий jsonrpc-метод, которым проверяется, действительна ли сессия из кэша
+SESSION_CHECK_METHOD = 'admin.md_classifier_version'
+# Cookie, которые сохраняются в кэше сессий
+SESSION_COOKIES = ('sessionid', 'csrftoken')
+# Cookie из кэша, истекающие раньше чем через столько секунд, не используются
+SESSION_CACHE_MARGIN = 60
 
 
 class Session(object):
     """В этом объекте хранятся все данные соединения с конкретным сервером"""
-    def __init__(self, server, login, password):
+    def __init__(self, server, login, password, pool_size=10, timeout=None, retries=0,
+                 retry_backoff=0.5, keep_alive=True, cache_dir=None):
+        """pool_size -- сколько соединений с сервером держать открытыми для параллельных запросов
+        timeout -- (таймаут соединения, таймаут чтения) в секундах для каждого запроса
+        retries -- сколько раз повторять идемпотентные запросы (GetCatalog, GetArchiveCatalog,
+                   читающие jsonrpc-методы) при сетевых ошибках и кодах 502/503/504;
+                   паузы между попытками: retry_backoff, 2*retry_backoff, 4*retry_backoff...
+        keep_alive -- если False, соединение закрывается после каждого запроса
+        cache_dir -- каталог кэша сессий: cookie sessionid и csrftoken сохраняются в файл
+                     cache_dir/<server>_<login>.json и при следующем запуске используются без
+                     входа на сервер, пока не истекут и пока сервер их принимает (проверяется
+                     одним запросом, см. check_session). Если сессия истечёт позже, то на отказ
+                     в доступе (см. is_auth_failure) выполняется вход и запрос повторяется.
+        """
         self.server = server
         self.base_url = 'http://%s' % server
         self.api_url = '%s/api/easo' % self.base_url
         self.webapi_url = '%s/webapi' % self.base_url
         self.jsonrpc_url = '%s/jsonrpc' % self.base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.counters_lock = Lock()
+        self.requests_count = defaultdict(int)  # endpoint -> число запросов
+        self.retries_count = defaultdict(int)  # endpoint -> число повторов
+        self.login_name = login
+        self.password = password
+        self.login_lock = Lock()
+        self.cached = False  # сессия взята из кэша и ещё не подтверждена входом
+        self.cache_file = None
+        if cache_dir is not None:
+            self.cache_file = os.path.join(cache_dir, '%s_%s.json' % (server.replace(':', '_'), login))
         self.session = requests.Session()
-        self.session.get('http://%s/login' % server)
-        self.csrftoken = self.session.cookies['csrftoken']
-        self.headers = {'X-CSRFToken':self.csrftoken}
-        self.headers_xml = self.headers.copy()
-        self.headers_xml['Content-Type'] = 'text/xml'
-        self.session.post('http://%s/login' % server, headers=self.headers,
-                          data={'login':login, 'password':password})
-        self.id = self.session.cookies['sessionid']
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.headers = {}
+        self.headers_xml = {'Content-Type':'text/xml'}
+        if not (self.load_cached_session() and self.check_session()):
+            self.login()
         self.getcatalog_from = 0
         # self.md_classifier_version (test.get_md_classifier_version)
 
+    def login(self):
+        """Войти на сервер: получить csrftoken и sessionid (и сохранить их в кэше сессий)"""
+        self.session.cookies.clear()
+        self.request('GET', '%s/login' % self.base_url, idempotent=True, reauth=False)
+        self.set_csrftoken(self.session.cookies['csrftoken'])
+        self.request('POST', '%s/login' % self.base_url, headers=self.headers, reauth=False,
+                     data={'login':self.login_name, 'password':self.password})
+        self.id = self.session.cookies['sessionid']
+        self.cached = False
+        self.save_cached_session()
+
+    def set_csrftoken(self, csrftoken):
+        self.csrftoken = csrftoken
+        # словари заголовков меняются на месте: они передаются в запросы по ссылке
+        self.headers['X-CSRFToken'] = csrftoken
+        self.headers_xml['X-CSRFToken'] = csrftoken
+
+    def load_cached_session(self):
+        """Взять sessionid и csrftoken из кэша сессий, если они там есть и не истекли.
+        Запросов к серверу не выполняется (см. check_session).
+        """
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return False
+        try:
+            with open(self.cache_file) as f:
+                cookies = json.load(f)
+        except ValueError:
+            return False
+        if sorted(cookie['name'] for cookie in cookies) != sorted(SESSION_COOKIES):
+            return False
+        for cookie in cookies:
+            if cookie['expires'] is not None and cookie['expires'] < time() + SESSION_CACHE_MARGIN:
+                return False
+        for cookie in cookies:
+            self.session.cookies.set_cookie(create_cookie(**cookie))
+        self.set_csrftoken(self.session.cookies['csrftoken'])
+        self.id = self.session.cookies['sessionid']
+        self.cached = True
+        return True
+
+    def save_cached_session(self):
+        if self.cache_file is None:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cookies = [{'name':cookie.name, 'value':cookie.value, 'domain':cookie.domain,
+                    'path':cookie.path, 'expires':cookie.expires}
+                   for cookie in self.session.cookies if cookie.name in SESSION_COOKIES]
+        # в файле идентификатор сессии, поэтому он доступен только владельцу
+        fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cookies, f)
+
+    def check_session(self):
+        """Проверить текущую сессию одним дешёвым запросом (SESSION_CHECK_METHOD).
+        Возвращает True, если сервер её принял.
+        """
+        try:
+            response = self.send('POST', '%s/%s' % (self.jsonrpc_url, SESSION_CHECK_METHOD),
+                                 idempotent=True, data={})
+        except requests.RequestException:
+            return False
+        if response.status_code != 200 or self.is_auth_failure(response):
+            return False
+        try:
+            return response.json().get('success') is True
+        except ValueError:
+            # например, страница входа вместо ответа jsonrpc
+            return False
+
+    @staticmethod
+    def is_auth_failure(response):
+        """Сервер отказал в доступе: код 401/403 или перенаправление на страницу входа
+        (так отвечает на запрос с истёкшей сессией Django, код при этом 200)
+        """
+        if response.status_code in AUTH_ERROR_STATUS_CODES:
+            return True
+        return bool(response.history) and urlparse(response.url).path.rstrip('/') == '/login'
+
+    def relogin(self, csrftoken):
+        """Войти заново, если сессия из кэша оказалась недействительной.
+        csrftoken -- токен, с которым был отправлен отвергнутый запрос; если другой поток уже
+        успел войти заново, повторный вход не выполняется. Возвращает True, если запрос имеет
+        смысл повторить.
+        """
+        with self.login_lock:
+            if self.csrftoken != csrftoken:
+                return True
+            if not self.cached:
+                return False
+            self.login()
+            return True
+
+    def request(self, method, url, idempotent=False, reauth=True, **kwargs):
+        """Выполнить запрос с таймаутом self.timeout и учётом в счётчиках.
+        Идемпотентные запросы повторяются (см. retries в __init__).
+        reauth -- если сессия взята из кэша и сервер отказал в доступе (см. is_auth_failure),
+        войти заново и повторить запрос (тело запроса не должно быть потоком и не должно
+        содержать идентификатор сессии).
+        """
+        csrftoken = self.headers.get('X-CSRFToken')
+        response = self.send(method, url, idempotent, **kwargs)
+        if reauth and self.is_auth_failure(response) and self.relogin(csrftoken):
+            headers = kwargs.get('headers')
+            if headers is not None and 'X-CSRFToken' in headers:
+                kwargs['headers'] = dict(headers, **{'X-CSRFToken':self.csrftoken})
+            response = self.send(method, url, idempotent, **kwargs)
+        return response
+
+    def send(self, method, url, idempotent=False, **kwargs):
+        """Выполнить запрос с повторами (см. self.request)"""
+        endpoint = url[len(self.base_url):]
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            with self.counters_lock:
+                self.requests_count[endpoint] += 1
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or attempt >= self.retries:
+                    raise
+            else:
+                if (not idempotent or attempt >= self.retries or
+                        response.status_code not in RETRY_STATUS_CODES):
+                    return response
+            with self.counters_lock:
+                self.retries_count[endpoint] += 1
+            sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+
+    def get_stats(self):
+        """Счётчики запросов и повторов по endpoint'ам, а также число открытых за время работы
+        соединений (если запросов заметно больше, чем соединений, то соединения переиспользуются).
+        """
+        pool = self.session.get_adapter(self.base_url).poolmanager.connection_from_url(self.base_url)
+        with self.counters_lock:
+            return {'requests': dict(self.requests_count),
+                    'retries': dict(self.retries_count),
+                    'connections': pool.num_connections}
+
     @staticmethod
     def gen_getarchivecatalog_xml(id):
         return """<?xml version='1.0' encoding='utf-8'?>
@@ -36,54 +228,121 @@ class Session(object):
                   </request>
                """.format(parcel_id=uuid4().hex, object_id=id)
 
-    def gen_getcatalog_xml(self):
+    def gen_getcatalog_xml(self, getcatalog_from=None):
+        if getcatalog_from is None:
+            getcatalog_from = self.getcatalog_from
         return """<?xml version='1.0' encoding='utf-8'?>
                   <request>
                     <header parcel_id="{parcel_id}"/>
                     <getCatalog from="{getcatalog_from}"/>
                   </request>
-               """.format(parcel_id=uuid4().hex, getcatalog_from=self.getcatalog_from)
+               """.format(parcel_id=uuid4().hex, getcatalog_from=getcatalog_from)
 
-    def get_catalog(self):
-        response = self.session.post('%s/GetCatalog' % self.api_url,
-                headers=self.headers_xml, data=self.gen_getcatalog_xml())
+    def get_catalog(self, getcatalog_from=None):
+        """getcatalog_from -- запросить только изменения с этого момента
+        (по умолчанию self.getcatalog_from; 0 -- весь каталог)
+        """
+        response = self.request('POST', '%s/GetCatalog' % self.api_url, idempotent=True,
+                headers=self.headers_xml, data=self.gen_getcatalog_xml(getcatalog_from))
         return response
 
     def get_archive_catalog(self, id):
-        response = self.session.post('%s/GetArchiveCatalog' % self.api_url,
+        response = self.request('POST', '%s/GetArchiveCatalog' % self.api_url, idempotent=True,
                 headers=self.headers_xml, data=self.gen_getarchivecatalog_xml(id))
         return response
 
     def upload_object(self, zipfile, xmlfile):
-        response = self.session.post('%s/PutObject' % self.api_url,
-                                     headers=self.headers,
-                                     data={'object_attrs': open(xmlfile).read()},
-                                     files={'object_file': open(zipfile, 'rb')})
+        """Отгрузить объект потоково (см. MultipartFileStream).
+        В ответ добавляются атрибуты upload_size (байт) и upload_seconds.
+        """
+        while True:
+            csrftoken = self.csrftoken
+            body = MultipartFileStream([('object_attrs', xmlfile, None),
+                                        ('object_file', zipfile, os.path.basename(zipfile))])
+            headers = self.headers.copy()
+            headers['Content-Type'] = body.content_type
+            time0 = time()
+            try:
+                # поток нельзя отправить повторно, поэтому после входа тело создаётся заново
+                response = self.request('POST', '%s/PutObject' % self.api_url,
+                                        headers=headers, data=body, reauth=False)
+            finally:
+                body.close()
+            if not self.is_auth_failure(response) or not self.relogin(csrftoken):
+                break
+        response.upload_size = len(body)
+        response.upload_seconds = time() - time0
         return response
 
     def run_jsonrpc(self, method, data={}):
-        return self.session.post('%s/%s' % (self.jsonrpc_url, method), data=data)
+        return self.request('POST', '%s/%s' % (self.jsonrpc_url, method), data=data,
+                            idempotent=method in JSONRPC_READ_METHODS)
+
+    @staticmethod
+    def build_params(params):
+        return params() if callable(params) else params
+
+    @staticmethod
+    def is_xmlrpc_fault(response):
+        try:
+            xmlrpclib.loads(response.content)
+        except xmlrpclib.Fault:
+            return True
+        except ExpatError:
+            pass
+        return False
 
     def run_xmlrpc(self, methodname, params):
-        xml = xmlrpclib.dumps(params, methodname=methodname, encoding='utf-8')
-        response = self.session.post(self.webapi_url, data=xml)
-        return response
+        """params -- параметры вызова или функция без аргументов, которая их строит.
+        Параметры с идентификатором сессии (self.id) нужно передавать функцией: webapi
+        отвечает на вызов с недействительной сессией кодом 200 и xml-rpc fault, и тогда, если
+        сессия взята из кэша и не прошла check_session, выполняется вход, параметры строятся
+        заново (уже с новым self.id) и вызов повторяется.
+        """
+        while True:
+            session_id = self.id
+            csrftoken = self.csrftoken
+            xml = xmlrpclib.dumps(self.build_params(params), methodname=methodname,
+                                  encoding='utf-8')
+            response = self.request('POST', self.webapi_url, data=xml, reauth=False)
+            if not (self.is_auth_failure(response) or self.is_xmlrpc_fault(response)):
+                return response
+            # другой поток мог уже войти заново, пока выполнялся вызов
+            if self.id == session_id and not (self.cached and not self.check_session() and
+                                              self.relogin(csrftoken)):
+                return response
+
+    def run_xmlrpc_multicall(self, calls):
+        """Выполнить несколько вызовов [(methodname, params), ...] одним запросом system.multicall
+        (params -- как в run_xmlrpc)
+        """
+        return self.run_xmlrpc('system.multicall', lambda: ([
+                {'methodName':methodname, 'params':list(self.build_params(params))}
+                for methodname, params in calls],))
 
     @staticmethod
-    def gen_deleteobject_xml(id, version):
+    def gen_deleteobjects_xml(idvers):
+        delete_versions = ''.join(
+                "<deleteVersion objectId='{id}' versionNumber='{version}'/>".format(
+                    id=id, version=int(float(version)))
+                for id, version in idvers)
         return """<?xml version='1.0' encoding='utf-8'?>
                   <request>
                     <header parcel_id='{parcel_id}'/>
-                    <deleteVersion objectId='{id}' versionNumber='{version}'/>
+                    {delete_versions}
                   </request>
-               """.format(parcel_id=uuid4().hex, id=id, version=int(float(version)))
+               """.format(parcel_id=uuid4().hex, delete_versions=delete_versions)
 
-    def delete_object(self, id, version):
-        response = self.session.post('%s/DeleteObjects' % self.api_url,
-                                     headers=self.headers_xml,
-                                     data=self.gen_deleteobject_xml(id, version))
+    def delete_objects(self, idvers):
+        """Удалить одним запросом DeleteObjects версии [(id, version), ...]"""
+        response = self.request('POST', '%s/DeleteObjects' % self.api_url,
+                                headers=self.headers_xml,
+                                data=self.gen_deleteobjects_xml(idvers))
         return response
 
+    def delete_object(self, id, version):
+        return self.delete_objects([(id, version)])
+
     def set_getcatalog_from(self, value):
         """Вызывается из методов класса Test"""
         if self.getcatalog_from == 0:
@@ -1,14 +1,24 @@
 # coding: utf-8
 import os
 import json
+import xmlrpclib
+from xml.parsers.expat import ExpatError
+from itertools import izip
 from lxml import etree
+import requests
 from zipfile import ZipFile
+from cStringIO import StringIO
 from glob import glob
-from time import time
-from copy import deepcopy
+from threading import Lock, Thread
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
 
-from utils import UnicodeException, wait
+from utils import UnicodeException, Poller, chunks, monotonic, roundrobin, wait
 from session import Session
+from catalog import read_catalog, keep_idvers, keep_ids, keep_names
+from latency import LatencyReport
+from upload_cache import UploadCache
+from dataset import Dataset, chart_record
 
 
 class TestError(UnicodeException):
@@ -25,23 +35,83 @@ class Test(object):
         self.logger = logger
         self.sessions = {}
         self.add_session('primary', self.config['primary_server'])
-        self.add_session('secondary', self.config['secondary_server'])
-        self.uploaded_objects = {}  # key -> (id, version)
-        self.unreplicated_objects_idvers = []  # заполняется одновременно с self.uploaded_objects
-        self.replicated_objects = {}  # key -> (id, version)
+        # Нижестоящие серверы: secondary_servers, либо один secondary_server.
+        # Сессии называются secondary, secondary2, secondary3, ...
+        self.secondary_names = []
+        for i, server in enumerate(self.config.get('secondary_servers') or
+                                   [self.config['secondary_server']]):
+            session_name = 'secondary' if i == 0 else 'secondary%d' % (i + 1)
+            self.add_session(session_name, server)
+            self.secondary_names.append(session_name)
+        self.uploaded_objects = {}  # (id, version) -> ChartRecord
+        # заполняется одновременно с self.uploaded_objects; объект убирается отсюда,
+        # когда среплицируется на все нижестоящие серверы
+        self.unreplicated_objects_idvers = []
+        # имя сессии нижестоящего сервера -> {(id, version) -> ChartRecord}
+        self.replicated_objects = dict((name, {}) for name in self.secondary_names)
         self.uploaded_objects_archives = []
         self.json_files = []
+        self.lock = Lock()  # защищает self.uploaded_objects и self.unreplicated_objects_idvers
+        # (id, version) -> момент (monotonic) последнего действия с объектом на вышестоящем сервере
+        self.action_times = {}
+        self.skipped_uploads = set()  # (id, version) объектов, отгрузка которых пропущена
+        self.latency = LatencyReport()
+        self.datasets = {}  # каталог с данными -> Dataset
+        self.upload_cache = None
+        if self.config.get('upload_cache_file'):
+            self.upload_cache = UploadCache(self.config['upload_cache_file'])
 
     @staticmethod
-    def set_getcatalog_from(session, tree):
+    def set_getcatalog_from(session, catalog):
         """Обновляет свойство getcatalog_from у сессии session"""
-        created = tree.get('Created')
-        session.set_getcatalog_from(created)
+        session.set_getcatalog_from(catalog.created)
+
+    def get_catalog_snapshot(self, session, full=False, keep=None):
+        """Вернуть индексированный каталог сервера.
+        Обычно запрашиваются объекты, изменённые с session.getcatalog_from (Created первого
+        полученного каталога). Когда проверяется отсутствие объекта, нужен full=True: тогда
+        каталог скачивается полностью (from=0). keep -- фильтр CHART'ов (см. read_catalog).
+        """
+        return self.download_catalog_snapshot(session, 0 if full else None, keep)
+
+    def download_catalog_snapshot(self, session, getcatalog_from=None, keep=None):
+        """Скачать каталог с сервера и вернуть его индексированный снимок"""
+        response = session.get_catalog(getcatalog_from)
+        if response.status_code != 200:
+            self.handle_error_response(response)
+        with self.open_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL') as xmlfile:
+            catalog = read_catalog(xmlfile, keep)
+        self.set_getcatalog_from(session, catalog)
+        return catalog
 
     def add_session(self, name, server):
-        self.sessions[name] = Session(server, self.config['login'], self.config['password'])
+        pool_size = max(10, self.config.get('upload_concurrency', 1),
+                        self.config.get('delete_concurrency', 1))
+        timeout = self.config.get('http_timeout')
+        self.sessions[name] = Session(server, self.config['login'], self.config['password'],
+                                      pool_size=self.config.get('http_pool_size', pool_size),
+                                      timeout=tuple(timeout) if timeout else None,
+                                      retries=self.config.get('http_retries', 0),
+                                      retry_backoff=self.config.get('http_retry_backoff', 0.5),
+                                      keep_alive=self.config.get('http_keep_alive', True),
+                                      cache_dir=self.config.get('session_cache_dir'))
+
+    def log_sessions_stats(self):
+        """Вывести счётчики запросов по каждому серверу (см. Session.get_stats)"""
+        for name, session in sorted(self.sessions.iteritems()):
+            stats = session.get_stats()
+            self.logger.info(u'%s (%s): запросов %d, повторов %d, соединений %d' %
+                             (name, session.server, sum(stats['requests'].values()),
+                              sum(stats['retries'].values()), stats['connections']))
+            for endpoint, count in sorted(stats['requests'].iteritems()):
+                self.logger.debug(u'  %s: %d' % (endpoint, count))
 
     def handle_error_response(self, response):
+        self.logger.error(self.format_error_response(response))
+        raise TestError
+
+    def format_error_response(self, response):
+        """Сообщение об ошибке по ответу сервера (без возбуждения исключения)"""
         msg = u'(код %s: %s)\n' % (response.status_code, response.reason)
         try:
             results = etree.fromstring(response.content).findall('.//result')
@@ -54,8 +124,7 @@ class Test(object):
             with open('last_error_response', 'wb') as f:
                 f.write(response.content)
             msg += u'Не удалось распарсить ответ сервера. Ответ сохранён в файле last_error_response.'
-        self.logger.error(msg)
-        raise TestError
+        return msg
 
     def precheck(self):
         """Набор проверок, которые нужно провести перед тестовыми операциями"""
@@ -66,57 +135,70 @@ class Test(object):
     def check_md_classifiers_match(self):
         """Проверить, что версии классификаторов метаданных на серверах совпадают"""
         primary_md_classifier_version = self.get_md_classifier_version('primary')
-        secondary_md_classifier_version = self.get_md_classifier_version('secondary')
-        if primary_md_classifier_version != secondary_md_classifier_version:
-            raise TestError(u'Версии классификаторов метаданных на серверах не совпадают')
+        for session_name in self.secondary_names:
+            secondary_md_classifier_version = self.get_md_classifier_version(session_name)
+            if primary_md_classifier_version != secondary_md_classifier_version:
+                raise TestError(u'Версии классификаторов метаданных на серверах %s и %s не совпадают' %
+                                (self.config['primary_server'], self.sessions[session_name].server))
 
     def get_names_from_pairs(self, pairs):
         """Вернуть словарь {name:class} из пар (zipfile,xmlfile)"""
         names = {}
         for zipfile, xmlfile in pairs:
-            tree = etree.parse(xmlfile)
-            chart = tree.find('.//chart')
-            name = chart.get('Name')
-            class_ = chart.get('Class')
-            names[name] = class_
+            entry = self.get_dataset_entry(xmlfile)
+            names[entry['Name']] = entry['Class']
         return names
 
     def check_names_not_exist_on_servers(self):
+        """Проверить, что объектов с именами из new_objects_dir нет на серверах.
+        В режиме upload_cache_skip допускаются объекты, которые уже были отгружены из тех же
+        файлов (см. self.find_cached_upload): они не будут отгружаться повторно.
+        """
         pairs = self.get_pairs(self.config['new_objects_dir'])
         names = self.get_names_from_pairs(pairs)
 
-        names_existing = {'primary':set(), 'secondary':set()}
-        for session_name in ('primary', 'secondary'):
+        session_names = ['primary'] + self.secondary_names
+        # полные каталоги (from=0); каталог вышестоящего сервера нужен и для поиска в манифесте
+        keep = keep_names(names.iteritems())
+        catalogs = dict((session_name, self.get_catalog_snapshot(self.sessions[session_name],
+                                                                 full=True, keep=keep))
+                        for session_name in session_names)
+
+        cached_idvers = {}  # Name -> (id, version) ранее отгруженного объекта
+        if self.upload_cache is not None and self.config.get('upload_cache_skip', False):
+            for pair in pairs:
+                cached = self.find_cached_upload(pair, catalogs['primary'])
+                if cached is not None:
+                    id, version, name = cached
+                    cached_idvers[name] = (id, version)
+
+        names_existing = dict((session_name, set()) for session_name in session_names)
+        for session_name in session_names:
             session = self.sessions[session_name]
-            response = session.get_catalog()
-            if response.status_code != 200:
-                self.handle_error_response(response)
-            tree = self.get_tree_from_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL')
-            self.set_getcatalog_from(session, tree)
+            catalog = catalogs[session_name]
             for name, class_ in names.iteritems():
-                if tree.find('.//CHART[@Name="%s"][@Class="%s"]' % (name, class_)) is not None:
-                    names_existing[session_name].add(name)
+                chart = catalog.find_by_name(name, class_)
+                if chart is None:
+                    continue
+                if cached_idvers.get(name) == (chart.get('ID'), chart.get('Issue')):
+                    self.logger.debug(u'Объект %s на сервере %s отгружен прошлым запуском' %
+                                      (name, session.server))
+                    continue
+                names_existing[session_name].add(name)
 
-        if names_existing['primary'] or names_existing['secondary']:
+        if any(names_existing.itervalues()):
             msg = u'Объекты, предназначенные для загрузки, уже есть на сервере:\n'
-            if names_existing['primary']:
-                msg += 'primary: %s\n' % names_existing['primary']
-            if names_existing['secondary']:
-                msg += 'secondary: %s\n' % names_existing['secondary']
+            for session_name in session_names:
+                if names_existing[session_name]:
+                    msg += '%s: %s\n' % (session_name, names_existing[session_name])
             raise TestError(msg)
 
     def add_uploaded_object(self, id, version, xmlfile):
         """С объектами в self.uploaded_objects мы потом сравниваем содержимое каталога(ов)."""
-        obj = {}
-        tree = etree.parse(xmlfile)
-        chart = tree.find('.//chart')
-        obj['Class'] = chart.get('Class')
-        obj['Name'] = chart.get('Name')
-        obj['Type'] = chart.get('Type')
-        attributes = tree.findall('.//Attribute')
-        for attribute in attributes:
-            obj[attribute.get('name')] = attribute.get('value')
-        self.uploaded_objects[(id, version)] = obj
+        obj = chart_record(self.get_dataset_entry(xmlfile))
+        with self.lock:
+            self.uploaded_objects[(id, version)] = obj
+            self.unreplicated_objects_idvers.append((id, version))
 
     def save_uploaded_objects_to_file(self, filename):
         """Сохранить информацию о загруженных объектах в файл в формате json.
@@ -125,7 +207,7 @@ class Test(object):
         uploaded_objects_1 = {}
         for idver, obj in self.uploaded_objects.iteritems():
             key = '%s-%s' % (idver[0], idver[1])
-            uploaded_objects_1[key] = obj
+            uploaded_objects_1[key] = obj.to_dict()
         with open(filename, 'w') as f:
             json.dump(uploaded_objects_1, f, encoding='utf-8', indent=2)
         self.json_files.append(filename)
@@ -135,48 +217,155 @@ class Test(object):
         и зачищает self.uploaded_objects, self.replicated_objects и
         self.unreplicated_objects_idvers, перед новым циклом загрузки-репликации.
         """
-        self.uploaded_objects_archives.append(deepcopy(self.uploaded_objects))
+        # записи неизменяемы, поэтому словарь переносится в архив без копирования
+        self.uploaded_objects_archives.append(self.uploaded_objects)
         self.uploaded_objects = {}
         self.unreplicated_objects_idvers = []
-        self.replicated_objects = {}
+        self.replicated_objects = dict((name, {}) for name in self.secondary_names)
 
     def get_pairs(self, directory):
         """Получить пары (zip-файл, xml-файл) из каталога directory.
         Для каждого найденного в directory zip-файла должен быть одноимённый xml-файл.
         """
+        return self.get_dataset(directory).pairs
+
+    def get_dataset(self, directory):
+        """Манифест набора данных из каталога directory (см. dataset.Dataset).
+        Строится один раз за прогон; если задан dataset_cache_dir, то сохраняется там и
+        используется следующими прогонами, пока файлы набора не изменятся.
+        """
+        directory = os.path.normpath(directory)
+        dataset = self.datasets.get(directory)
+        if dataset is not None:
+            return dataset
         pairs = []
-        for zipfile in glob('%s/*.zip' % directory):
+        for zipfile in sorted(glob('%s/*.zip' % directory)):
             xmlfile = os.path.splitext(zipfile)[0] + '.xml'
             if not os.path.isfile(xmlfile):
                 raise TestError(u'Для файла %s не найден соответствующий xml-файл %s' %
                                 (zipfile, xmlfile))
             pairs.append((zipfile, xmlfile))
-        return pairs
+        manifest_file = None
+        if self.config.get('dataset_cache_dir'):
+            manifest_file = '%s/%s.json' % (self.config['dataset_cache_dir'],
+                                            directory.strip('/').replace('/', '_'))
+        dataset = Dataset(pairs, manifest_file)
+        if dataset.updated:
+            self.logger.debug(u'Манифест набора данных %s: обновлено записей %d из %d' %
+                              (directory, dataset.updated, len(pairs)))
+        self.datasets[directory] = dataset
+        return dataset
 
-    def put_objects_from_directory(self, directory):
-        """Отгрузить все объекты из заданного каталога на вышестоящий сервер. """
+    def get_dataset_entry(self, xmlfile):
+        """Запись манифеста набора данных для xml-файла объекта"""
+        xmlfile = os.path.normpath(xmlfile)
+        return self.get_dataset(os.path.dirname(xmlfile))[xmlfile]
+
+    def put_objects_from_directory(self, directory, uploaded_queue=None):
+        """Отгрузить все объекты из заданного каталога на вышестоящий сервер.
+        Объекты отгружаются параллельно в upload_concurrency потоков, а ответы сервера
+        обрабатываются в порядке следования пар. Если какая-то отгрузка не удалась, исключение
+        возбуждается только после учёта всех успешно отгруженных объектов, чтобы их можно было
+        потом удалить.
+        uploaded_queue -- очередь, в которую кладётся (id, version, время отгрузки) каждого
+        отгруженного объекта, а по окончании отгрузки -- None.
+        Если задан upload_cache_file, отгрузки запоминаются в манифесте по SHA-256 пары файлов,
+        а в режиме upload_cache_skip пара, уже отгруженная ранее и имеющаяся в каталоге
+        вышестоящего сервера в той же версии, повторно не отгружается.
+        """
         pairs = self.get_pairs(directory)
-        for zipfile, xmlfile in pairs:
-            name = os.path.splitext(os.path.basename(zipfile))[0]
-            response = self.sessions['primary'].upload_object(zipfile, xmlfile)
-            if response.status_code == 200:
+        session = self.sessions['primary']
+        catalog = None
+        if self.upload_cache is not None and self.config.get('upload_cache_skip', False):
+            names = self.get_names_from_pairs(pairs)
+            catalog = self.get_catalog_snapshot(session, full=True,
+                                                keep=keep_names(names.iteritems()))
+
+        def upload(pair):
+            """Вернуть (ответ сервера или None, найденная в манифесте отгрузка, SHA-256 пары,
+            время отгрузки)
+            """
+            digest = None
+            if self.upload_cache is not None:
+                digest = self.get_dataset_entry(pair[1])['sha256']
+            if catalog is not None:
+                cached = self.find_cached_upload(pair, catalog, digest)
+                if cached is not None:
+                    return None, cached, digest, monotonic()
+            response = session.upload_object(*pair)
+            return response, None, digest, monotonic()
+
+        pool = ThreadPool(self.config.get('upload_concurrency', 1))
+        try:
+            responses = pool.imap(upload, pairs)
+            errors = []
+            for zipfile, xmlfile in pairs:
                 try:
-                    tree = etree.fromstring(response.content)
-                    obj = tree.find('.//object')
-                    id = obj.get('objectId')
-                    version = obj.get('version')
-                    self.logger.info_ok(u'Объект %s отправлен (id=%s, version=%s).' %
-                                        (name, id, version))
-                    self.add_uploaded_object(id, version, xmlfile)
-                    self.unreplicated_objects_idvers = self.uploaded_objects.keys()
-                except etree.XMLSyntaxError, e:
-                    with open('%s/upload_object_error' % self.config['results_dir'], 'wb') as f:
-                        f.write(response.content)
-                    self.logger.error(u'Не удалось распарсить ответ сервера. Ответ сохранён в файле '
-                                 u'%s/upload_object_error' % self.config['results_dir'])
-                    raise TestError
-            else:
-                self.handle_error_response(response)
+                    response, cached, digest, time_uploaded = responses.next()
+                    if cached is None:
+                        id, version = self.handle_upload_response(response, zipfile, xmlfile)
+                        if digest is not None:
+                            self.upload_cache.put(session.server, digest, id, version,
+                                                  self.uploaded_objects[(id, version)]['Name'])
+                    else:
+                        id, version, name = cached
+                        self.logger.info_ok(u'Объект %s уже есть на сервере (id=%s, version=%s), '
+                                            u'отгрузка пропущена.' % (name, id, version))
+                        self.add_uploaded_object(id, version, xmlfile)
+                        self.skipped_uploads.add((id, version))
+                    self.action_times[(id, version)] = time_uploaded
+                    if uploaded_queue is not None:
+                        uploaded_queue.put((id, version, time_uploaded))
+                except Exception, e:
+                    errors.append(e)
+            if errors:
+                raise errors[0]
+        finally:
+            pool.close()
+            pool.join()
+            if self.upload_cache is not None:
+                self.upload_cache.save()
+            if uploaded_queue is not None:
+                uploaded_queue.put(None)
+
+    def find_cached_upload(self, pair, catalog, digest=None):
+        """Вернуть (id, version, name) из манифеста отгрузок, если пара pair уже отгружалась на
+        вышестоящий сервер и эта версия объекта есть в его каталоге catalog (как последняя),
+        иначе None. digest -- SHA-256 пары, если уже посчитан.
+        """
+        if digest is None:
+            digest = self.get_dataset_entry(pair[1])['sha256']
+        cached = self.upload_cache.get(self.sessions['primary'].server, digest)
+        if cached is None:
+            return None
+        id, version, name = cached
+        chart = catalog.find(id, version)
+        if chart is None or chart.get('Name') != name:
+            return None
+        return cached
+
+    def handle_upload_response(self, response, zipfile, xmlfile):
+        """Учесть отгруженный объект; возвращает (id, version)"""
+        name = os.path.splitext(os.path.basename(zipfile))[0]
+        if response.status_code == 200:
+            try:
+                tree = etree.fromstring(response.content)
+                obj = tree.find('.//object')
+                id = obj.get('objectId')
+                version = obj.get('version')
+                self.logger.info_ok(u'Объект %s отправлен (id=%s, version=%s, %.1f КБ/с).' %
+                                    (name, id, version, response.upload_size / 1024.0 /
+                                     max(response.upload_seconds, 1e-6)))
+                self.add_uploaded_object(id, version, xmlfile)
+                return id, version
+            except etree.XMLSyntaxError, e:
+                with open('%s/upload_object_error' % self.config['results_dir'], 'wb') as f:
+                    f.write(response.content)
+                self.logger.error(u'Не удалось распарсить ответ сервера. Ответ сохранён в файле '
+                             u'%s/upload_object_error' % self.config['results_dir'])
+                raise TestError
+        else:
+            self.handle_error_response(response)
 
     def check_jsonrpc_response(self, response, method):
         if response.status_code != 200:
@@ -195,11 +384,11 @@ class Test(object):
         response = self.sessions['primary'].run_jsonrpc(method=method, data={'script_id':script_id})
         self.check_jsonrpc_response(response, method)
 
-    def download_files(self):
-        """Запустить задачу "ЗагрузкаФайловИзДиректории" (url /adminpanel/ikp/) на втором сервере"""
+    def download_files(self, session_name='secondary'):
+        """Запустить задачу "ЗагрузкаФайловИзДиректории" (url /adminpanel/ikp/) на нижестоящем сервере"""
         method = 'admin.run_script'
         script_id = 17  # из таблицы adminpanel_ikpscript
-        response = self.sessions['secondary'].run_jsonrpc(method=method, data={'script_id':script_id})
+        response = self.sessions[session_name].run_jsonrpc(method=method, data={'script_id':script_id})
         self.check_jsonrpc_response(response, method)
 
     def get_replicant(self, name):
@@ -246,110 +435,108 @@ class Test(object):
         """На вышестоящем сервере у всех загруженных объектов:
         - меняем атрибут c201 (scale) на 987654;
         - добавляем к атрибуту c122 (name) " штрих"
+        У каждого объекта свои метаданные (c122), поэтому на объект -- отдельный вызов
+        set_chart_metadata; при metadata_multicall вызовы упаковываются по metadata_batch_size
+        штук в system.multicall.
         """
-        md_classifier_version = self.get_md_classifier_version()
         session = self.sessions['primary']
         self.logger.debug(u'Меняем атрибут scale на 987654 и добавляем к атрибуту c122 " штрих".')
         self.logger.debug(u'Для изменения метаданных нужно скачать каталог с вышестоящего сервера.')
-        response = session.get_catalog()
-        if response.status_code != 200:
-            self.handle_error_response(response)
-        catalog_tree = self.get_tree_from_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL')
-        self.set_getcatalog_from(session, catalog_tree)
+        catalog = self.get_catalog_snapshot(
+                session, keep=keep_ids(id for id, version in self.uploaded_objects))
+        calls = []  # ([(id, version)], params)
         for (id, version), obj in self.uploaded_objects.iteritems():
-            chart = catalog_tree.find('.//CHART[@ID="%s"]' % id)
+            chart = catalog.find_by_id(id)
             metadata = {}
-            for attr, value in chart.attrib.iteritems():
+            for attr, value in chart.iteritems():
                 if attr.startswith('c'):
                     metadata[attr] = value
             metadata['c122'] += u' штрих'
             metadata['c201'] = 987654
-            updated = float(chart.attrib['Updated'])
-            try:
-                tags = metadata['c234'].split('|')
-            except KeyError:
-                tags = []
-            params = (
-                self.sessions['primary'].id,
-                md_classifier_version,
-                [{'id':id, 'updated':updated}],  # chart_ids
-                metadata,  # md_item
-                []  #tags
-            )
-            response = self.sessions['primary'].run_xmlrpc('set_chart_metadata', params)
-            # response.status_code здесь ни о чём не говорит (он всегда 200)
-            try:
-                tree = etree.fromstring(response.content)
-                success = tree.xpath('.//name[text()="success"]/following-sibling::value/boolean')[0].text
-                if success == '0':
-                    msg = tree.xpath('.//name[text()="msg"]/following-sibling::value/string')[0].text
-                    raise TestError(msg)
-                self.logger.info_ok(u'Изменены метаданные объекта с id=%s' % id)
-            except etree.XMLSyntaxError, e:
-                with open('%s/change_metadata_error' % self.config['results_dir'], 'wb') as f:
-                    f.write(response.content)
-                self.logger.error(u'Не удалось распарсить ответ сервера. Ответ сохранён в файле '
-                             u'%s/change_metadata_error' % self.config['results_dir'])
-                raise TestError
+            updated = float(chart['Updated'])
+            params = self.set_chart_metadata_params([{'id':id, 'updated':updated}], metadata)
+            calls.append(([(id, version)], params))
 
-    def track_changing_metadata(self, time_dec):
-        """Проверка, что изменились метаданные на нижестоящем сервере.
-        Изменения можно посмотреть в методе self.change_metadata().
-        time_dec - убавка от текущего времени (если перед запуском метода был wait)
-        """
-        time0 = time() - time_dec
-        self.unreplicated_objects_idvers = self.uploaded_objects.keys()
-        seconds_left = self.config['max_timeout']
-        session = self.sessions['secondary']
-        while seconds_left > 0:
-            if self.config['variant'] == 'gateway':
-                self.download_files()
-                self.logger.info(u'Таймаут после выполнения задачи "ЗагрузкаФайловИзДиректории": '
-                                 u'%d секунд' % self.config['download_files_timeout'])
-                wait(self.config['download_files_timeout'])
-            response = session.get_catalog()
-            if response.status_code != 200:
-                self.handle_error_response(response)
-            tree = self.get_tree_from_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL')
-            self.set_getcatalog_from(session, tree)
-            for idver in self.unreplicated_objects_idvers:
-                id, version = idver
-                chart = tree.find('.//CHART[@ID="%s"]' % id)
-                if chart is None:
-                    raise TestError(u'Куда-то внезапно с нижестоящего сервера исчез объект с id=%s' % id)
-                c122 = chart.get('c122')
-                c201 = chart.get('c201')
-                if c122.endswith(u'штрих') and c201 == '987654':
-                    self.logger.info_ok(u'Среплицировались метаданные объекта с id=%s (%d сек.)' %
-                                        (id, int(time()-time0)))
-                    seconds_left = self.config['max_timeout']  # восстанавливаем оставшееся время
-                    self.unreplicated_objects_idvers.remove(idver)
-
-            # всё ли среплицировалось
-            if len(self.unreplicated_objects_idvers) == 0:
-                self.logger.info_ok(u'Метаданные всех объектов среплицировались!')
-                break
-            else:
-                self.logger.warn(u'Метаданные не всех объектов среплицировались: %s' %
-                            self.unreplicated_objects_idvers)
-                self.logger.info(u'Cледующая попытка через %d секунд' % self.config['period'])
-                wait(self.config['period'])
-                seconds_left -= self.config['period']
-                continue
-
-        # Истекло время max_timeout
+        batch_size = self.config.get('metadata_batch_size', 1)
+        if self.config.get('metadata_multicall', False):
+            results = self.run_set_chart_metadata_multicall(calls, batch_size)
         else:
-            self.logger.error(u'%d секунд без репликации новых объектов' % self.config['max_timeout'])
-            self.logger.error(u'Не среплицировались объекты с (id, версией): %s' %
-                         self.unreplicated_objects_idvers)
+            results = [self.run_set_chart_metadata(params) for idvers, params in calls]
+
+        failed = []
+        for (idvers, params), msg in zip(calls, results):
+            for idver in idvers:
+                if msg is None:
+                    self.action_times[idver] = monotonic()
+                    self.logger.info_ok(u'Изменены метаданные объекта с id=%s' % idver[0])
+                else:
+                    failed.append(idver[0])
+                    self.logger.error(u'Не изменены метаданные объекта с id=%s: %s' %
+                                      (idver[0], msg))
+        if failed:
+            raise TestError(u'Не удалось изменить метаданные объектов с id: %s' % failed)
+
+    def load_xmlrpc_response(self, response):
+        """Разобрать ответ xml-rpc; xmlrpclib.Fault пробрасывается дальше"""
+        # response.status_code здесь ни о чём не говорит (он всегда 200)
+        try:
+            return xmlrpclib.loads(response.content)[0][0]
+        except ExpatError, e:
+            with open('%s/change_metadata_error' % self.config['results_dir'], 'wb') as f:
+                f.write(response.content)
+            self.logger.error(u'Не удалось распарсить ответ сервера. Ответ сохранён в файле '
+                         u'%s/change_metadata_error' % self.config['results_dir'])
             raise TestError
 
-        # Все объекты среплицировались, проверяем соответствие метаданных
-        success = self.compare_uploaded_and_replicated_objects()
-        if success is True:
-            self.logger.info_ok(u'Метаданные загруженных и реплицированных объектов совпадают.')
-        else:
-            raise TestError(u'Метаданные загруженных и реплицированных объектов не совпадают.')
+    @staticmethod
+    def get_set_chart_metadata_error(result):
+        """Вернуть сообщение об ошибке из результата set_chart_metadata или None"""
+        if result.get('success'):
+            return None
+        return result.get('msg', u'success != true')
+
+    def set_chart_metadata_params(self, chart_ids, md_item, tags=()):
+        """Параметры set_chart_metadata для Session.run_xmlrpc: функция, которая строит их
+        с текущим идентификатором сессии (он меняется при повторном входе)
+        """
+        session = self.sessions['primary']
+        md_classifier_version = self.get_md_classifier_version()
+        return lambda: (session.id, md_classifier_version, chart_ids, md_item, list(tags))
+
+    def run_set_chart_metadata(self, params):
+        """Вызвать set_chart_metadata; возвращает None или сообщение об ошибке"""
+        response = self.sessions['primary'].run_xmlrpc('set_chart_metadata', params)
+        try:
+            result = self.load_xmlrpc_response(response)
+        except xmlrpclib.Fault, e:
+            return e.faultString
+        return self.get_set_chart_metadata_error(result)
+
+    def run_set_chart_metadata_multicall(self, calls, batch_size):
+        """Выполнить вызовы set_chart_metadata пачками через system.multicall.
+        Если сервер не поддерживает system.multicall, оставшиеся вызовы выполняются по одному.
+        Возвращает список (None или сообщение об ошибке) по вызовам.
+        """
+        session = self.sessions['primary']
+        results = []
+        for i in xrange(0, len(calls), batch_size):
+            batch = calls[i:i+batch_size]
+            response = session.run_xmlrpc_multicall(
+                    [('set_chart_metadata', params) for idvers, params in batch])
+            try:
+                batch_results = self.load_xmlrpc_response(response)
+            except xmlrpclib.Fault, e:
+                self.logger.warn(u'Сервер не поддерживает system.multicall (%s), '
+                                 u'метаданные будут изменяться по одному вызову' % e.faultString)
+                for idvers, params in calls[i:]:
+                    results.append(self.run_set_chart_metadata(params))
+                return results
+            for result in batch_results:
+                if isinstance(result, dict):  # fault отдельного вызова
+                    results.append(result.get('faultString', u'fault'))
+                else:
+                    results.append(self.get_set_chart_metadata_error(result[0]))
+        return results
 
     def get_all_idvers(self):
         """Возвращает все idver'ы когда-либо загруженных объектов."""
@@ -363,225 +550,483 @@ class Test(object):
 
     def delete_uploaded_objects(self, error=False):
         """Удалить загруженные объекты с вышестоящего сервера.
-        error - вызов функции вследствие возбуждения исключения
+        error - вызов функции вследствие возбуждения исключения; в этом случае реплицированные
+        объекты удаляются с нижестоящих серверов одновременно с вышестоящим.
         """
         idvers = self.get_all_idvers()
         if not idvers:
             return
 
+        batch_size = self.config.get('delete_batch_size', 1)
         self.logger.info(u'Удаляю загруженные объекты с сервера %s' % self.config['primary_server'])
-        for id, version in idvers:
-            response = self.sessions['primary'].delete_object(id, version)
-            if response.status_code == 200:
-                self.logger.info_ok(u'Объект (id=%s, version=%s) удалён.' % (id, version))
-            else:
-                self.handle_error_response(response)
+        primary_batches = [('primary', batch) for batch in chunks(idvers, batch_size)]
+        secondary_batches = []
+        if error is True and self.config['variant'] in ('correcting_replication', 'gateway'):
+            for session_name in self.secondary_names:
+                replicated_idvers = self.replicated_objects[session_name].keys()
+                if replicated_idvers:
+                    self.logger.info(u'Удаляю реплицированные объекты с сервера %s' %
+                                     self.sessions[session_name].server)
+                    secondary_batches.append([(session_name, batch) for batch in
+                                              chunks(replicated_idvers, batch_size)])
+        failures = self.run_deletion_plan(roundrobin(primary_batches, *secondary_batches))
+        if failures:
+            raise TestError(u'Не удалось удалить объектов: %d' % len(failures))
 
+    def run_deletion_plan(self, batches):
+        """Удалить объекты пачками: batches -- [(имя сессии, [(id, version), ...]), ...].
+        Каждая пачка удаляется одним запросом DeleteObjects, пачки выполняются параллельно
+        в delete_concurrency потоков. Если пачка не удалилась, её версии удаляются по одной,
+        чтобы выяснить, какие именно не удаляются. Ошибки не прерывают удаление остальных.
+        Возвращает список неудач [(имя сессии, (id, version), сообщение), ...].
+        """
+        def delete(batch):
+            """Вернуть [((id, version), время удаления или None, сообщение об ошибке), ...]"""
+            session_name, idvers = batch
+            try:
+                response = self.sessions[session_name].delete_objects(idvers)
+            except requests.RequestException, e:
+                response = None
+                msg = unicode(e)
+            if response is not None and response.status_code == 200:
+                time_deleted = monotonic()
+                return [(idver, time_deleted, None) for idver in idvers]
+            if len(idvers) > 1:
+                results = []
+                for idver in idvers:
+                    results.extend(delete((session_name, [idver])))
+                return results
+            if response is not None:
+                msg = self.format_error_response(response)
+            return [(idvers[0], None, msg)]
 
-        if error is True:
-            if self.config['variant'] in ('correcting_replication', 'gateway') and self.replicated_objects.keys():
-                self.logger.info(u'Удаляю реплицированные объекты с сервера %s' %
-                                    self.config['secondary_server'])
-                for id, version in self.replicated_objects.keys():
-                    response = self.sessions['secondary'].delete_object(id, version)
-                    if response.status_code == 200:
-                        self.logger.info_ok(u'Объект (id=%s, version=%s) удалён.' % (id, version))
+        failures = []
+        pool = ThreadPool(self.config.get('delete_concurrency', 1))
+        try:
+            for (session_name, idvers), results in izip(batches, pool.imap(delete, batches)):
+                server = self.sessions[session_name].server
+                for (id, version), time_deleted, msg in results:
+                    if msg is None:
+                        if session_name == 'primary':
+                            self.action_times[(id, version)] = time_deleted
+                        self.logger.info_ok(u'Объект (id=%s, version=%s) с сервера %s удалён.' %
+                                            (id, version, server))
                     else:
-                        self.handle_error_response(response)
+                        failures.append((session_name, (id, version), msg))
+                        self.logger.error(u'Не удалось удалить объект (id=%s, version=%s) с сервера '
+                                          u'%s: %s' % (id, version, server, msg))
+        finally:
+            pool.close()
+            pool.join()
+        return failures
 
-    def delete_objects_by_names(self):
-        """Удалить объекты с серверов (все версии), используя атрибуты "Name" и "Class"."""
-        self.logger.info(u'Удаляю с серверов объекты по именам...')
+    def delete_objects_by_names(self, dry_run=False):
+        """Удалить объекты с серверов (все версии), используя атрибуты "Name" и "Class".
+        Сначала строится полный план удаления: каталоги серверов и архивные каталоги всех
+        найденных объектов запрашиваются параллельно (в delete_concurrency потоков). План
+        выводится в лог, и, если это не dry_run, выполняется одновременно на всех серверах.
+        """
+        self.logger.info(u'Составляю план удаления объектов с серверов по именам...')
         pairs = self.get_pairs(self.config['new_objects_dir'])
         names = self.get_names_from_pairs(pairs)
-        for session_name in ('primary', 'secondary'):
-            session = self.sessions[session_name]
-            response = session.get_catalog()
-            if response.status_code != 200:
-                self.handle_error_response(response)
-            tree = self.get_tree_from_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL')
-            self.set_getcatalog_from(session, tree)
-            for name, class_ in names.iteritems():
-                chart = tree.find('.//CHART[@Name="%s"][@Class="%s"]' % (name, class_))
-                if chart is not None:
-                    id = chart.get('ID')
-                    version = chart.get('Issue')
+        session_names = ['primary'] + self.secondary_names
+        pool = ThreadPool(self.config.get('delete_concurrency', 1))
+        try:
+            keep = keep_names(names.iteritems())
+            catalogs = pool.map(lambda session_name: self.get_catalog_snapshot(
+                                    self.sessions[session_name], full=True, keep=keep),
+                                session_names)
+            found = []  # (имя сессии, Name, Class, ID, Issue)
+            for session_name, catalog in zip(session_names, catalogs):
+                for name, class_ in sorted(names.iteritems()):
+                    chart = catalog.find_by_name(name, class_)
                     if chart is not None:
-                        # Запрашиваю все версии
-                        response1 = session.get_archive_catalog(id)
-                        if response1.status_code != 200:
-                            self.handle_error_response(response1)
-                        tree1 = self.get_tree_from_xml_from_zip_from_response(response1,
-                                'GetArchiveCatalog.zip', 'catalog.xml')
-                        charts1 = tree1.findall('.//CHART')
-                        if charts1:  # архивные версии имеются
-                            for chart1 in charts1:
-                                name1 = chart1.get('Name')
-                                class_1 = chart1.get('Class')
-                                id1 = chart1.get('ID')
-                                version1 = chart1.get('Issue')
-                                if name1 != name or class_1 != class_ or id1 != id:
-                                    raise TestError(u'В архивном каталоге для объекта %s не совпал '
-                                            u'какой-то из атрибутов: Name, Class, ID' % name)
-                                # Удаление архивных версий
-                                response2 = session.delete_object(id1, version1)
-                                if response2.status_code != 200:
-                                    self.handle_error_response(response2)
-                                self.logger.info_ok(u'Объект %s (id=%s, version=%s) с сервера %s удалён.' %
-                                                    (name1, id1, version1, session.server))
-                        # Удаление последней версии
-                        response1 = session.delete_object(id, version)
-                        if response1.status_code != 200:
-                            self.handle_error_response(response1)
-                        self.logger.info_ok(u'Объект %s (id=%s, version=%s) с сервера %s удалён.' %
-                                            (name, id, version, session.server))
+                        found.append((session_name, name, class_, chart.get('ID'), chart.get('Issue')))
+            archive_idvers = pool.map(lambda args: self.get_archive_idvers(*args[:4]), found)
+        finally:
+            pool.close()
+            pool.join()
+
+        plan = dict((session_name, []) for session_name in session_names)
+        for (session_name, name, class_, id, version), idvers in zip(found, archive_idvers):
+            # Сначала архивные версии, затем последняя -- одним запросом DeleteObjects
+            idvers = idvers + [(id, version)]
+            plan[session_name].append((session_name, idvers))
+            for id1, version1 in idvers:
+                self.logger.info(u'План: удалить объект %s (id=%s, version=%s) с сервера %s' %
+                                 (name, id1, version1, self.sessions[session_name].server))
+        if not found:
+            self.logger.info_ok(u'Объектов для удаления не найдено.')
+        if dry_run:
+            self.logger.info(u'Пробный запуск: объекты не удаляются.')
+            return
+        failures = self.run_deletion_plan(roundrobin(*[plan[session_name]
+                                                       for session_name in session_names]))
+        if failures:
+            raise TestError(u'Не удалось удалить объектов: %d' % len(failures))
+
+    def get_archive_idvers(self, session_name, name, class_, id):
+        """Вернуть [(id, version), ...] архивных версий объекта с сервера session_name"""
+        session = self.sessions[session_name]
+        response = session.get_archive_catalog(id)
+        if response.status_code != 200:
+            self.handle_error_response(response)
+        tree = self.get_tree_from_xml_from_zip_from_response(response,
+                'GetArchiveCatalog.zip', 'catalog.xml')
+        idvers = []
+        for chart in tree.findall('.//CHART'):
+            if chart.get('Name') != name or chart.get('Class') != class_ or chart.get('ID') != id:
+                raise TestError(u'В архивном каталоге для объекта %s не совпал '
+                                u'какой-то из атрибутов: Name, Class, ID' % name)
+            idvers.append((chart.get('ID'), chart.get('Issue')))
+        return idvers
 
     def get_tree_from_xml_from_zip_from_response(self, response, zipfilename, xmlfilename):
-        resfile = '%s/%s' % (self.config['results_dir'], zipfilename)
-        with open(resfile, 'wb') as F:
-            F.write(response.content)
-        self.logger.debug(u'Записан архив %s' % resfile)
-        zf = ZipFile(resfile)
+        with self.open_xml_from_zip_from_response(response, zipfilename, xmlfilename) as xmlfile:
+            tree = etree.parse(xmlfile).getroot()
+        return tree
+
+    def open_xml_from_zip_from_response(self, response, zipfilename, xmlfilename):
+        """Открыть на чтение xml-файл xmlfilename из zip-архива в теле ответа.
+        На диск (results_dir/zipfilename) архив записывается только при save_catalog_zips.
+        """
+        if self.config.get('save_catalog_zips', False):
+            resfile = '%s/%s' % (self.config['results_dir'], zipfilename)
+            with open(resfile, 'wb') as F:
+                F.write(response.content)
+            self.logger.debug(u'Записан архив %s' % resfile)
+        # cStringIO, в отличие от io.BytesIO, не копирует переданную строку
+        zf = ZipFile(StringIO(response.content))
         if xmlfilename not in zf.namelist():
             raise TestError(u'Почему-то в архиве каталога нет файла %s' % xmlfilename)
-        xmlfile = zf.read(xmlfilename)
-        tree = etree.fromstring(xmlfile)
-        return tree
+        return zf.open(xmlfilename)
 
-    def track_replication(self, time_dec):
-        """Отслеживаем изменения на нижестоящем сервере
-        time_dec - убавка от текущего времени (если перед запуском метода был wait)
+    def make_poller(self):
+        """Расписание опросов нижестоящих серверов для методов track_*.
+        До первого прогресса даётся first_timeout + max_timeout секунд, после каждого
+        прогресса -- max_timeout; интервал между опросами -- от poll_min_interval до period.
         """
-        time0 = time() - time_dec
-        seconds_left = self.config['max_timeout']
-        session = self.sessions['secondary']
-        while seconds_left > 0:
-            if self.config['variant'] == 'gateway':
-                self.download_files()
-                self.logger.info(u'Таймаут после выполнения задачи "ЗагрузкаФайловИзДиректории": '
-                                 u'%d секунд' % self.config['download_files_timeout'])
-                wait(self.config['download_files_timeout'])
-            response = session.get_catalog()
-            if response.status_code != 200:
-                self.handle_error_response(response)
-            tree = self.get_tree_from_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL')
-            self.set_getcatalog_from(session, tree)
-            for idver in self.unreplicated_objects_idvers:
-                id, version = idver
-                chart = tree.find('.//CHART[@ID="%s"][@Issue="%s"]' % (id, version))
-                if chart is not None:
-                    self.logger.info_ok(u'Среплицировался объект с id=%s и версией %s (%d сек.)' %
-                                        (id, version, int(time()-time0)))
-                    seconds_left = self.config['max_timeout']  # восстанавливаем оставшееся время
-                    self.unreplicated_objects_idvers.remove(idver)
-                    self.replicated_objects[idver] = chart.attrib
+        return Poller(self.config['max_timeout'], first_timeout=self.config['first_timeout'],
+                      min_interval=self.config.get('poll_min_interval', 1),
+                      max_interval=self.config['period'])
 
-            # всё ли среплицировалось
-            if len(self.unreplicated_objects_idvers) == 0:
-                self.logger.info_ok(u'Все объекты среплицировались!')
-                break
+    @staticmethod
+    def check_phase(phase):
+        """Имя этапа должно быть строкой. Раньше первым аргументом методов track_* была убавка
+        времени time_dec, и старый вызов track_replication(30) должен падать, а не давать
+        этап с именем 30.
+        """
+        if not isinstance(phase, basestring):
+            raise TypeError('phase must be a phase name, not %r (time_dec is no longer '
+                            'accepted)' % (phase,))
+
+    def track_replicas(self, phase, pending, check, on_found, found_message, pending_message,
+                       uploaded_queue=None, on_uploaded=None, full_catalog=False, untimed=()):
+        """Общий цикл опроса нижестоящих серверов для методов track_*.
+        pending -- {имя сессии: set((id, version))}: изменения, ещё не дошедшие до сервера;
+        check(catalog, (id, version)) -- результат (истина), если изменение видно в каталоге;
+        on_found(имя сессии, (id, version), результат check) -- вызывается для дошедшего изменения
+        (уже убранного из pending);
+        found_message, pending_message -- сообщения в лог о дошедшем изменении (с местами для id,
+        version и сервера; задержка дописывается в конце) и о недошедших;
+        uploaded_queue -- очередь из put_objects_from_directory: отгружаемые по ходу опроса
+        объекты добавляются в pending всех серверов; по окончании отгрузки вызывается on_uploaded();
+        full_catalog -- при каждом опросе скачивать полный каталог (check проверяет отсутствие);
+        untimed -- изменения, для которых задержка не записывается (например, объекты, отгрузка
+        которых пропущена: их не отгружали в этом запуске).
+        Каталоги серверов запрашиваются параллельно, задержка считается по каждому серверу.
+        Сервер, на котором max_timeout секунд (до первого изменения -- first_timeout + max_timeout)
+        ничего не менялось, больше не опрашивается; пока идёт отгрузка, таймаут не наступает.
+        Опрос заканчивается, когда каждый сервер либо догнал вышестоящий, либо вышел по таймауту.
+        Возвращает True, если отгрузка закончилась и догнали все.
+        """
+        self.check_phase(phase)
+        time0 = monotonic()
+        session_names = self.secondary_names
+        deadlines = dict((name, time0 + self.config['first_timeout'] + self.config['max_timeout'])
+                         for name in session_names)
+        timed_out = set()
+        uploading = uploaded_queue is not None
+        poller = self.make_poller()
+        pool = ThreadPool(len(session_names))
+        try:
+            for _ in poller:
+                while uploading:
+                    try:
+                        item = uploaded_queue.get_nowait()
+                    except Empty:
+                        break
+                    if item is None:
+                        uploading = False
+                        on_uploaded()
+                    else:
+                        id, version, time_uploaded = item
+                        for name in session_names:
+                            pending[name].add((id, version))
+                            deadlines[name] = monotonic() + self.config['max_timeout']
+                        poller.progress()
+                if uploading:
+                    # пока объекты отгружаются, опрос по времени не заканчивается
+                    poller.hold()
+
+                active = [name for name in session_names if pending[name] and name not in timed_out]
+                if active and self.config['variant'] == 'gateway':
+                    pool.map(self.download_files, active)
+                    self.logger.info(u'Таймаут после выполнения задачи "ЗагрузкаФайловИзДиректории": '
+                                     u'%d секунд' % self.config['download_files_timeout'])
+                    wait(self.config['download_files_timeout'])
+
+                def fetch(name):
+                    # объекты, отгрузка которых пропущена, в этом запуске не менялись и в окно
+                    # каталога (from=getcatalog_from) не попадают
+                    full = full_catalog or not self.skipped_uploads.isdisjoint(pending[name])
+                    time_seen = monotonic()
+                    return time_seen, self.get_catalog_snapshot(self.sessions[name], full,
+                                                                keep_idvers(pending[name]))
+
+                for name, (time_seen, catalog) in zip(active, pool.map(fetch, active)):
+                    server = self.sessions[name].server
+                    for idver in sorted(pending[name]):
+                        result = check(catalog, idver)
+                        if not result:
+                            continue
+                        if idver in untimed:
+                            self.logger.info_ok(found_message % (idver + (server,)))
+                        else:
+                            latency = time_seen - self.action_times.get(idver, time0)
+                            self.logger.info_ok(u'%s (%.1f сек.)' %
+                                                (found_message % (idver + (server,)), latency))
+                            self.latency.record(phase, server, idver, latency)
+                        pending[name].discard(idver)
+                        on_found(name, idver, result)
+                        deadlines[name] = monotonic() + self.config['max_timeout']
+                        poller.progress()
+                    if pending[name]:
+                        self.logger.debug(u'%s на сервере %s: %s' %
+                                          (pending_message, server, sorted(pending[name])))
+
+                now = monotonic()
+                for name in active:
+                    if pending[name] and now >= deadlines[name] and not uploading:
+                        timed_out.add(name)
+                        self.logger.error(u'%d секунд без изменений на сервере %s' %
+                                          (self.config['max_timeout'], self.sessions[name].server))
+                        self.logger.error(u'%s на сервере %s: %s' % (pending_message,
+                                          self.sessions[name].server, sorted(pending[name])))
+
+                if not uploading and all(not pending[name] or name in timed_out
+                                         for name in session_names):
+                    break
+
+            # Истекло время max_timeout на всех ещё не догнавших серверах
             else:
-                self.logger.warn(u'Не все объекты среплицировались: %s' % self.unreplicated_objects_idvers)
-                self.logger.info(u'Cледующая попытка через %d секунд' % self.config['period'])
-                wait(self.config['period'])
-                seconds_left -= self.config['period']
-                continue
+                for name in session_names:
+                    if pending[name] and name not in timed_out:
+                        self.logger.error(u'%s на сервере %s: %s' % (pending_message,
+                                          self.sessions[name].server, sorted(pending[name])))
+        finally:
+            pool.close()
+            pool.join()
+        self.save_latency_report(phase)
+        if uploading:
+            self.logger.error(u'Опрос закончился раньше отгрузки объектов')
+            return False
+        return not any(pending.itervalues())
 
-        # Истекло время max_timeout
-        else:
-            self.logger.error(u'%d секунд без репликации новых объектов' % self.config['max_timeout'])
-            self.logger.error(u'Не среплицировались объекты с (id, версией): %s' %
-                              self.unreplicated_objects_idvers)
-            if len(self.replicated_objects) == 0:
+    def new_pending(self, idvers):
+        """Ожидаемые изменения {имя сессии: set((id, version))} для track_replicas"""
+        return dict((name, set(idvers)) for name in self.secondary_names)
+
+    def on_replicated(self, pending):
+        """Обработчик track_replicas для репликации новых объектов: запомнить реплицированный
+        объект и убрать его из self.unreplicated_objects_idvers, когда он дошёл до всех серверов.
+        """
+        def on_found(session_name, idver, chart):
+            with self.lock:
+                self.replicated_objects[session_name][idver] = chart
+                if not any(idver in idvers for idvers in pending.itervalues()):
+                    self.unreplicated_objects_idvers.remove(idver)
+        return on_found
+
+    def track_replication(self, phase='new_objects'):
+        """Отслеживаем изменения на нижестоящих серверах.
+        Опрос начинается сразу и прекращается, как только все объекты среплицируются на все
+        серверы (или на отстающих серверах истечёт время, см. self.track_replicas()).
+        """
+        self.check_phase(phase)
+        pending = self.new_pending(self.unreplicated_objects_idvers)
+        success = self.track_replicas(phase, pending,
+                                      lambda catalog, idver: catalog.find(*idver),
+                                      self.on_replicated(pending),
+                                      u'Среплицировался объект с id=%s и версией %s на сервер %s',
+                                      u'Не среплицировались объекты с (id, версией)',
+                                      untimed=self.skipped_uploads)
+        if not success:
+            if not any(self.replicated_objects.itervalues()):
                 msg = (u'Возможно, недостаточно прав у пользователя с ролью "Банк данных" '
                        u'на сервере %s' % self.config['primary_server'])
             else:
                 msg = ''
             raise TestError(msg)
+        self.logger.info_ok(u'Все объекты среплицировались!')
+        self.check_replicated_objects()
 
-        # Все объекты среплицировались, проверяем соответствие метаданных
-        success = self.compare_uploaded_and_replicated_objects()
-        if success is True:
-            self.logger.info_ok(u'Метаданные загруженных и реплицированных объектов совпадают.')
-        else:
-            raise TestError(u'Метаданные загруженных и реплицированных объектов не совпадают.')
+    def put_and_track_objects_from_directory(self, directory, phase='new_objects'):
+        """Конвейерный режим: отгрузка объектов из directory на вышестоящий сервер идёт в
+        отдельном потоке, а нижестоящие серверы опрашиваются с самого начала. Задержка репликации
+        каждого объекта считается от момента его отгрузки, а этап длится не сумму, а максимум
+        времени отгрузки и времени репликации.
+        """
+        if not self.track_uploads(
+                lambda uploaded_queue: self.put_objects_from_directory(directory, uploaded_queue),
+                phase):
+            raise TestError
+        self.logger.info_ok(u'Все объекты среплицировались!')
+        self.check_replicated_objects()
+
+    def track_uploads(self, put, phase):
+        """Отслеживать репликацию объектов, пока они отгружаются.
+        put(uploaded_queue) выполняется в отдельном потоке и кладёт в очередь (id, version,
+        время отгрузки) каждого отгруженного объекта, а по окончании -- None (как
+        put_objects_from_directory). Возвращает True, если всё среплицировалось.
+        """
+        self.check_phase(phase)
+        uploaded_queue = Queue()
+        upload_errors = []
+
+        def upload():
+            try:
+                put(uploaded_queue)
+            except Exception, e:
+                upload_errors.append(e)
+
+        uploader = Thread(target=upload)
+        uploader.daemon = True
+        uploader.start()
+
+        def on_uploaded():
+            uploader.join()
+            if upload_errors:
+                raise upload_errors[0]
+
+        pending = self.new_pending([])
+        try:
+            return self.track_replicas(phase, pending,
+                                       lambda catalog, idver: catalog.find(*idver),
+                                       self.on_replicated(pending),
+                                       u'Среплицировался объект с id=%s и версией %s на сервер '
+                                       u'%s',
+                                       u'Не среплицировались объекты с (id, версией)',
+                                       uploaded_queue, on_uploaded, untimed=self.skipped_uploads)
+        finally:
+            uploader.join()
 
     def assure_stream_replication_is_disabled(self):
         """Если что-то среплицируется, то вызовется исключение."""
-        session = self.sessions['secondary']
-        response = session.get_catalog()
-        if response.status_code != 200:
-            self.handle_error_response(response)
-        tree = self.get_tree_from_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL')
-        self.set_getcatalog_from(session, tree)
-        for idver in self.unreplicated_objects_idvers:
-            id, version = idver
-            chart = tree.find('.//CHART[@ID="%s"][@Issue="%s"]' % (id, version))
-            if chart is not None:
-                raise TestError(u'Потоковая репликация не выключена!')
+        for session_name in self.secondary_names:
+            catalog = self.get_catalog_snapshot(self.sessions[session_name],
+                                                keep=keep_idvers(self.unreplicated_objects_idvers))
+            for idver in self.unreplicated_objects_idvers:
+                id, version = idver
+                chart = catalog.find(id, version)
+                if chart is not None:
+                    raise TestError(u'Потоковая репликация на сервер %s не выключена!' %
+                                    self.sessions[session_name].server)
         self.logger.info_ok('OK')
 
-    def track_deletion(self, time_dec):
-        """Отслеживаем удаление объектов на нижестоящем сервере.
-        time_dec - убавка от текущего времени (если перед запуском метода был wait)
+    def track_changing_metadata(self, phase='metadata'):
+        """Проверка, что изменились метаданные на нижестоящих серверах.
+        Изменения можно посмотреть в методе self.change_metadata().
+        Опрос начинается сразу (см. self.track_replicas()).
+        """
+        self.check_phase(phase)
+        self.unreplicated_objects_idvers = self.uploaded_objects.keys()
+        pending = self.new_pending(self.unreplicated_objects_idvers)
+
+        def check(catalog, idver):
+            chart = catalog.find_by_id(idver[0])
+            if chart is None:
+                raise TestError(u'Куда-то внезапно с нижестоящего сервера исчез объект с id=%s' %
+                                idver[0])
+            return chart.get('c122').endswith(u'штрих') and chart.get('c201') == '987654'
+
+        def on_found(session_name, idver, result):
+            with self.lock:
+                if not any(idver in idvers for idvers in pending.itervalues()):
+                    self.unreplicated_objects_idvers.remove(idver)
+
+        success = self.track_replicas(phase, pending, check, on_found,
+                                      u'Среплицировались метаданные объекта с id=%s (версия %s) '
+                                      u'на сервер %s',
+                                      u'Не среплицировались метаданные объектов с (id, версией)')
+        if not success:
+            raise TestError
+        self.logger.info_ok(u'Метаданные всех объектов среплицировались!')
+        self.check_replicated_objects()
+
+    def track_deletion(self, phase='deletion'):
+        """Отслеживаем удаление объектов на нижестоящих серверах.
+        Опрос начинается сразу (см. self.track_replicas()). Проверяется отсутствие объектов,
+        поэтому каталоги всегда скачиваются полностью. Задержка записывается только для текущих
+        версий (self.uploaded_objects): прежних версий в каталоге уже не было, их отсутствие
+        лишь проверяется.
         """
-        time0 = time() - time_dec
+        self.check_phase(phase)
         idvers = self.get_all_idvers()
-        seconds_left = self.config['max_timeout']
-        session = self.sessions['secondary']
-        while seconds_left > 0:
-            if self.config['variant'] == 'gateway':
-                self.download_files()
-                self.logger.info(u'Таймаут после выполнения задачи "ЗагрузкаФайловИзДиректории": '
-                                 u'%d секунд' % self.config['download_files_timeout'])
-                wait(self.config['download_files_timeout'])
-            response = session.get_catalog()
-            if response.status_code != 200:
-                self.handle_error_response(response)
-            tree = self.get_tree_from_xml_from_zip_from_response(response, 'GetCatalog.zip', 'WF.CLL')
-            self.set_getcatalog_from(session, tree)
-            for idver in idvers:
-                id, version = idver
-                chart = tree.find('.//CHART[@ID="%s"][@Issue="%s"]' % (id, version))
-                if chart is None:
-                    self.logger.info_ok(u'Удалился объект с id=%s и версией %s (%d сек.)' %
-                                        (id, version, int(time()-time0)))
-                    seconds_left = self.config['max_timeout']  # восстанавливаем оставшееся время
-                    idvers.remove(idver)
-
-            # все ли удаления среплицировались
-            if len(idvers) == 0:
-                self.logger.info_ok(u'Все объекты удалились!')
-                break
-            else:
-                self.logger.warn(u'Не все объекты удалились: %s' % idvers)
-                self.logger.info(u'Cледующая попытка через %d секунд' % self.config['period'])
-                wait(self.config['period'])
-                seconds_left -= self.config['period']
-                continue
+        pending = self.new_pending(idvers)
+        archived = set(idvers) - set(self.uploaded_objects)
+        success = self.track_replicas(phase, pending,
+                                      lambda catalog, idver: catalog.find(*idver) is None,
+                                      lambda session_name, idver, result: None,
+                                      u'Удалился объект с id=%s и версией %s на сервере %s',
+                                      u'Не удалились объекты с (id, версией)',
+                                      full_catalog=True,
+                                      untimed=archived | self.skipped_uploads)
+        if not success:
+            raise TestError
+        self.logger.info_ok(u'Все объекты удалились!')
 
-        # Истекло время max_timeout
+    def save_latency_report(self, phase):
+        """Вывести сводку задержек этапа phase по каждому нижестоящему серверу и сохранить
+        отчёт по всем этапам в results_dir/latency.json (сводка) и results_dir/latency.csv
+        (задержки объектов).
+        """
+        for session_name in self.secondary_names:
+            server = self.sessions[session_name].server
+            summary = self.latency.summary(phase, server)
+            if summary['count']:
+                self.logger.info(u'Задержки этапа %s на сервере %s (%d объектов): p50=%.1f '
+                                 u'p90=%.1f p99=%.1f max=%.1f сек.' %
+                                 (phase, server, summary['count'], summary['p50'],
+                                  summary['p90'], summary['p99'], summary['max']))
+        self.latency.save('%s/latency.json' % self.config['results_dir'],
+                          '%s/latency.csv' % self.config['results_dir'])
+
+    def check_replicated_objects(self):
+        """Все объекты среплицировались, проверяем соответствие метаданных"""
+        success = self.compare_uploaded_and_replicated_objects()
+        if success is True:
+            self.logger.info_ok(u'Метаданные загруженных и реплицированных объектов совпадают.')
         else:
-            self.logger.error(u'%d секунд без удаления неудалившихся объектов' %
-                         self.config['max_timeout'])
-            self.logger.error(u'Не удалились объекты с (id, версией): %s' %
-                         self.unreplicated_objects_idvers)
-            raise TestError
+            raise TestError(u'Метаданные загруженных и реплицированных объектов не совпадают.')
 
     def compare_uploaded_and_replicated_objects(self):
-        assert(set(self.uploaded_objects.keys()) == set(self.replicated_objects.keys()))
         success = True
-        for idver in self.uploaded_objects.iterkeys():
-            id, version = idver
-            for attr in self.uploaded_objects[idver].iterkeys():
-                if attr not in self.replicated_objects[idver]:
-                    success = False
-                    self.logger.warn(u'Не найден атрибут %s у объекта с id=%s и версией %s' %
-                                (attr, id, version))
-                elif self.uploaded_objects[idver][attr] != self.replicated_objects[idver][attr]:
-                    success = False
-                    self.logger.warn(u'Не совпадают атрибуты %s (%s != %s) у объекта с id=%s и версией %s' %
-                                (attr, self.uploaded_objects[idver][attr],
-                                 self.replicated_objects[idver][attr], id, version))
+        for session_name in self.secondary_names:
+            server = self.sessions[session_name].server
+            replicated_objects = self.replicated_objects[session_name]
+            assert(set(self.uploaded_objects.keys()) == set(replicated_objects.keys()))
+            for idver in self.uploaded_objects.iterkeys():
+                id, version = idver
+                for attr in self.uploaded_objects[idver].iterkeys():
+                    if attr not in replicated_objects[idver]:
+                        success = False
+                        self.logger.warn(u'Не найден атрибут %s у объекта с id=%s и версией %s '
+                                         u'на сервере %s' % (attr, id, version, server))
+                    elif self.uploaded_objects[idver][attr] != replicated_objects[idver][attr]:
+                        success = False
+                        self.logger.warn(u'Не совпадают атрибуты %s (%s != %s) у объекта с id=%s и '
+                                         u'версией %s на сервере %s' %
+                                         (attr, self.uploaded_objects[idver][attr],
+                                          replicated_objects[idver][attr], id, version, server))
         return success
-
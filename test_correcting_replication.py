@@ -16,14 +16,29 @@ _config = {
     "replicationPeriod": 10,
     "login": "user1",
     "password": "12345678",
+    "http_timeout": [10, 300],
+    "http_retries": 3,
+    "http_retry_backoff": 1,
+    "http_keep_alive": True,
+    "session_cache_dir": "results/sessions",
     "data_dir": "data",
     "results_dir": "results",
+    "save_catalog_zips": False,
     "new_objects_dir": "data/put_new_objects",
     "new_versions_dir": "data/put_new_versions",
+    "dataset_cache_dir": "results/datasets",
+    "upload_cache_file": "results/upload_cache.json",
+    "upload_cache_skip": False,
+    "upload_concurrency": 4,
     "assure_timeout": 60,
     "first_timeout": 30,
     "max_timeout": 30,
     "period": 10,
+    "poll_min_interval": 1,
+    "metadata_batch_size": 20,
+    "metadata_multicall": True,
+    "delete_batch_size": 20,
+    "delete_concurrency": 4,
     "delete_objects_on_error": True,
     "loglevel": "INFO_OK"
 }
@@ -40,10 +55,11 @@ logger = get_logger('colorlog', _config['loglevel'])
 test = Test(_config, logger)
 
 # Специальный случай: если загруженные объекты не были удалены после предыдущего запуска скрипта
+# (delete --dry-run -- только показать, что будет удалено)
 if len(sys.argv) > 1 and sys.argv[1].startswith('delete'):
     logger.info(u'Удаляю объекты с серверов по именам. Имена беру из xml-файлов в каталоге %s' %
                 _config['new_objects_dir'])
-    test.delete_objects_by_names()
+    test.delete_objects_by_names(dry_run='--dry-run' in sys.argv)
     sys.exit(0)
 
 try:
@@ -65,10 +81,8 @@ try:
 
     logger.info(u'Запускаю корректирующую репликацию')
     test.run_correcting_replication(_config['replicant_name'])
-    logger.info(u'Жду, пока случится репликация (%d секунд)' % _config['first_timeout'])
-    wait(_config['first_timeout'])
     logger.info(u'Периодически проверяю, среплицировались ли новые объекты')
-    test.track_replication(_config['first_timeout'])
+    test.track_replication()
 
     # Помещение новых версий тех же объектов
     logger.info(u'Загружаю из каталога %s на вышестоящий сервер новые версии тех же объектов.'
@@ -77,28 +91,22 @@ try:
     test.put_objects_from_directory(_config['new_versions_dir'])
     logger.info(u'Запускаю корректирующую репликацию')
     test.run_correcting_replication(_config['replicant_name'])
-    logger.info(u'Жду, пока случится репликация (%d секунд)' % _config['first_timeout'])
-    wait(_config['first_timeout'])
     logger.info(u'Периодически проверяю, среплицировались ли новые версии')
-    test.track_replication(_config['first_timeout'])
+    test.track_replication('new_versions')
 
     # # Изменение метаданных
     # logger.info(u'Меняем метаданные всех объектов...')
     # test.change_metadata()
     # logger.info(u'Запускаю корректирующую репликацию')
     # test.run_correcting_replication(_config['replicant_name'])
-    # logger.info(u'Жду, пока случится репликация (%d секунд)' % _config['first_timeout'])
-    # wait(_config['first_timeout'])
-    # test.track_changing_metadata(_config['first_timeout'])
+    # test.track_changing_metadata()
 
     # # Удаление объектов
     # logger.info(u'Удаляем все загруженные объекты')
     # test.delete_uploaded_objects()
     # logger.info(u'Запускаю корректирующую репликацию')
     # test.run_correcting_replication(_config['replicant_name'])
-    # logger.info(u'Жду, пока случится репликация (%d секунд)' % _config['first_timeout'])
-    # wait(_config['first_timeout'])
-    # test.track_deletion(_config['first_timeout'])
+    # test.track_deletion()
 
 except TestError, e:
     logger.critical(u'Ошибка теста')
@@ -121,5 +129,6 @@ except Exception:
     raise
 
 else:
+    test.log_sessions_stats()
     time1 = time()
     logger.info_ok(u'\nТест успешно пройден! Время прогона: %d сек.' % int(time1-time0))
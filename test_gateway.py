@@ -3,24 +3,39 @@ import os
 import sys
 from time import time
 
-from utils import get_logger, wait
+from utils import get_logger
 from test import Test, TestError
 
 
 _config = {
     "variant": "gateway",
     "primary_server": "10.10.152.72",
-    "secondary_server": "10.10.152.100",
+    "secondary_servers": ["10.10.152.100"],
     "login": "user1",
     "password": "12345678",
+    "http_timeout": [10, 300],
+    "http_retries": 3,
+    "http_retry_backoff": 1,
+    "http_keep_alive": True,
+    "session_cache_dir": "results/sessions",
     "data_dir": "data",
     "results_dir": "results",
+    "save_catalog_zips": False,
     "new_objects_dir": "data/put_new_objects",
     "new_versions_dir": "data/put_new_versions",
+    "dataset_cache_dir": "results/datasets",
+    "upload_cache_file": "results/upload_cache.json",
+    "upload_cache_skip": False,
+    "upload_concurrency": 4,
     "first_timeout": 90,
     "max_timeout": 60,
     "period": 10,
+    "poll_min_interval": 1,
+    "metadata_batch_size": 20,
+    "metadata_multicall": True,
     "download_files_timeout": 10,
+    "delete_batch_size": 20,
+    "delete_concurrency": 4,
     "delete_objects_on_error": True,
     "loglevel": "INFO_OK"
 }
@@ -37,10 +52,11 @@ logger = get_logger('colorlog', _config['loglevel'])
 test = Test(_config, logger)
 
 # Специальный случай: если загруженные объекты не были удалены после предыдущего запуска скрипта
+# (delete --dry-run -- только показать, что будет удалено)
 if len(sys.argv) > 1 and sys.argv[1].startswith('delete'):
     logger.info(u'Удаляю объекты с серверов по именам. Имена беру из xml-файлов в каталоге %s' %
                 _config['new_objects_dir'])
-    test.delete_objects_by_names()
+    test.delete_objects_by_names(dry_run='--dry-run' in sys.argv)
     sys.exit(0)
 
 try:
@@ -54,9 +70,7 @@ try:
     test.put_objects_from_directory(_config['new_objects_dir'])
     logger.info(u'Запускаю задачу "ВыгрузкаФайлов"')
     test.offload_files()
-    logger.info(u'Жду, пока объекты пройдут через шлюз (%d секунд)' % _config['first_timeout'])
-    wait(_config['first_timeout'])
-    test.track_replication(_config['first_timeout'])
+    test.track_replication()
 
     # Помещение новых версий тех же объектов
     logger.info(u'Загружаю из каталога %s на сервер %s новые версии тех же объектов.' %
@@ -65,27 +79,21 @@ try:
     test.put_objects_from_directory(_config['new_versions_dir'])
     logger.info(u'Запускаю задачу "ВыгрузкаФайлов"')
     test.offload_files()
-    logger.info(u'Жду, пока объекты пройдут через шлюз (%d секунд)' % _config['first_timeout'])
-    wait(_config['first_timeout'])
-    test.track_replication(_config['first_timeout'])
+    test.track_replication('new_versions')
 
     # Изменение метаданных
     logger.info(u'Меняем метаданные всех объектов на сервере %s' % _config['primary_server'])
     test.change_metadata()
     logger.info(u'Запускаю задачу "ВыгрузкаФайлов"')
     test.offload_files()
-    logger.info(u'Жду, пока объекты пройдут через шлюз (%d секунд)' % _config['first_timeout'])
-    wait(_config['first_timeout'])
-    test.track_changing_metadata(_config['first_timeout'])
+    test.track_changing_metadata()
 
     # Удаление объектов
     logger.info(u'Удаляем все загруженные объекты')
     test.delete_uploaded_objects()
     logger.info(u'Запускаю задачу "ВыгрузкаФайлов"')
     test.offload_files()
-    logger.info(u'Жду, пока объекты пройдут через шлюз (%d секунд)' % _config['first_timeout'])
-    wait(_config['first_timeout'])
-    test.track_deletion(_config['first_timeout'])
+    test.track_deletion()
 
 except TestError, e:
     logger.critical(u'Ошибка теста')
@@ -108,5 +116,6 @@ except Exception:
     raise
 
 else:
+    test.log_sessions_stats()
     time1 = time()
     logger.info_ok(u'\nТест успешно пройден! Время прогона: %d сек.' % int(time1-time0))
@@ -0,0 +1,147 @@
+# coding: utf-8
+"""Нагрузочный прогон: в течение load_duration секунд на вышестоящий сервер отгружаются объекты
+из load_objects_dir (см. generate_dataset.py), меняются их метаданные и они удаляются.
+Сводка (пропускная способность, доля ошибок, перцентили задержек запросов, задержка репликации)
+сохраняется в results_dir/load.json, временной ряд -- в results_dir/load.csv.
+В режиме load_mode="open" объекты только отгружаются с открытым циклом по очереди с каждой
+интенсивностью из open_loop_rates (см. load.OpenLoopSweep); свод -- в results_dir/open_loop.json.
+
+python test_load.py                      -- прогон на серверах из _config
+python test_load.py mock                 -- прогон на паре локальных mock-серверов
+python test_load.py delete [--dry-run]   -- удалить объекты, оставшиеся от прошлого прогона
+"""
+import os
+import sys
+import atexit
+import traceback
+from time import time
+
+from utils import get_logger
+from test import Test, TestError
+from load import LoadGenerator, OpenLoopSweep
+
+
+_config = {
+    "variant": "load",
+    "primary_server": "10.10.152.85",
+    "secondary_servers": ["10.10.152.86"],
+    "login": "user1",
+    "password": "12345678",
+    "http_timeout": [10, 300],
+    "http_retries": 3,
+    "http_retry_backoff": 1,
+    "http_keep_alive": True,
+    "session_cache_dir": "results/sessions",
+    "data_dir": "data",
+    "results_dir": "results",
+    "save_catalog_zips": False,
+    "new_objects_dir": "data/generated/put_new_objects",
+    "dataset_cache_dir": "results/datasets",
+    "load_objects_dir": "data/generated/put_new_objects",
+    # "rate" -- load_rate операций в секунду, "concurrency" -- без пауз,
+    # "open" -- отгрузка с открытым циклом по open_loop_rates
+    "load_mode": "rate",
+    "load_rate": 5,
+    "load_concurrency": 8,
+    "load_duration": 300,
+    # доли операций
+    "load_mix": {"upload": 0.7, "metadata": 0.2, "delete": 0.1},
+    # период замера отставания нижестоящих серверов (results_dir/replication_lag.csv)
+    "lag_sample_interval": 5,
+    # сколько ждать репликации после окончания нагрузки
+    "drain_timeout": 120,
+    "open_loop_rates": [1, 2, 5, 10, 20],
+    # "fixed" -- через равные промежутки, "poisson" -- пуассоновский поток
+    "open_loop_arrivals": "poisson",
+    "open_loop_step_duration": 60,
+    # сколько запросов может выполняться одновременно
+    "open_loop_workers": 64,
+    "first_timeout": 30,
+    "max_timeout": 30,
+    "period": 10,
+    "poll_min_interval": 1,
+    "seed": 1,
+    "delete_batch_size": 20,
+    "delete_concurrency": 4,
+    "delete_objects_on_error": True,
+    "loglevel": "INFO"
+}
+
+
+# Preliminaries
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+if not os.path.isdir(_config['results_dir']):
+    os.mkdir(_config['results_dir'])
+logger = get_logger('colorlog', _config['loglevel'])
+
+if len(sys.argv) > 1 and sys.argv[1] == 'mock':
+    import mock_server
+    primary, secondary = mock_server.start_pair(mock_server._config, logger)
+    # остановить пару до завершения интерпретатора, иначе её фоновые потоки падают при выходе
+    atexit.register(mock_server.stop_pair, primary, secondary)
+    _config['primary_server'] = primary.address
+    _config['secondary_servers'] = [secondary.address]
+    _config['login'] = mock_server._config['login']
+    _config['password'] = mock_server._config['password']
+    _config['session_cache_dir'] = None
+
+
+# Action
+test = Test(_config, logger)
+
+if len(sys.argv) > 1 and sys.argv[1].startswith('delete'):
+    logger.info(u'Удаляю объекты с серверов по именам. Имена беру из xml-файлов в каталоге %s' %
+                _config['new_objects_dir'])
+    test.delete_objects_by_names(dry_run='--dry-run' in sys.argv)
+    sys.exit(0)
+
+
+def cleanup_after_error():
+    """Удалить отгруженные объекты после ошибки. Ошибки удаления только логируются, чтобы
+    не заслонить исходную ошибку теста.
+    """
+    try:
+        test.delete_uploaded_objects(error=True)
+        if load is not None:
+            load.cleanup()
+    except Exception:
+        logger.error(u'Не удалось удалить загруженные объекты')
+        logger.error(traceback.format_exc().decode('utf-8'))
+
+
+load = None
+try:
+    time0 = time()
+    logger.info(u'Выполняю предварительную проверку...')
+    test.precheck()
+
+    if _config['load_mode'] == 'open':
+        OpenLoopSweep(test, _config).run()
+        logger.info(u'Удаляю все загруженные объекты')
+        test.delete_uploaded_objects()
+    else:
+        load = LoadGenerator(test, _config)
+        load.run()
+        logger.info(u'Удаляю оставшиеся загруженные объекты')
+        load.cleanup()
+
+except TestError, e:
+    logger.critical(u'Ошибка теста')
+    if _config['delete_objects_on_error']:
+        logger.info(u'Удаляю все загруженные объекты')
+        cleanup_after_error()
+    logger.critical(u'Тест провален')
+    if e.message:
+        logger.critical(e.message)
+
+except Exception:
+    logger.critical(u'Произошла непредвиденная ошибка!')
+    if _config['delete_objects_on_error']:
+        logger.info(u'Удаляю все загруженные объекты')
+        cleanup_after_error()
+    raise
+
+else:
+    test.log_sessions_stats()
+    time1 = time()
+    logger.info_ok(u'\nНагрузочный прогон завершён. Время прогона: %d сек.' % int(time1-time0))
@@ -0,0 +1,87 @@
+# coding: utf-8
+import os
+import sys
+from time import time
+
+from utils import get_logger
+from pairs_driver import PairsTestDriver
+
+
+_config = {
+    "variant": "stream_replication",
+    "pairs": [
+        ["10.10.152.85", "10.10.152.86"],
+        ["10.10.152.87", "10.10.152.88"]
+    ],
+    "login": "user1",
+    "password": "12345678",
+    "http_timeout": [10, 300],
+    "http_retries": 3,
+    "http_retry_backoff": 1,
+    "http_keep_alive": True,
+    "session_cache_dir": "results/sessions",
+    "data_dir": "data",
+    "results_dir": "results",
+    "save_catalog_zips": False,
+    "new_objects_dir": "data/put_new_objects",
+    "new_versions_dir": "data/put_new_versions",
+    "dataset_cache_dir": "results/datasets",
+    "upload_cache_file": "results/upload_cache.json",
+    "upload_cache_skip": False,
+    "upload_concurrency": 4,
+    "first_timeout": 30,
+    "max_timeout": 30,
+    "period": 10,
+    "poll_min_interval": 1,
+    "metadata_batch_size": 20,
+    "metadata_multicall": True,
+    "delete_batch_size": 20,
+    "delete_concurrency": 4,
+    "delete_objects_on_error": True,
+    "loglevel": "INFO_OK"
+}
+
+
+def scenario(test):
+    """Сценарий test_stream_replication.py для одной пары серверов"""
+    config = test.config
+    test.logger.info(u'Выполняю предварительную проверку...')
+    test.precheck()
+
+    test.logger.info(u'Загружаю из каталога %s новые объекты.' % config['new_objects_dir'])
+    test.put_and_track_objects_from_directory(config['new_objects_dir'])
+
+    test.logger.info(u'Загружаю из каталога %s новые версии тех же объектов.' %
+                     config['new_versions_dir'])
+    test.backup_and_clear_uploaded_objects()
+    test.put_and_track_objects_from_directory(config['new_versions_dir'], 'new_versions')
+
+    test.logger.info(u'Меняю метаданные всех объектов')
+    test.change_metadata()
+    test.track_changing_metadata()
+
+    test.logger.info(u'Удаляю все загруженные объекты')
+    test.delete_uploaded_objects()
+    test.track_deletion()
+
+
+# Preliminaries
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+if not os.path.isdir(_config['results_dir']):
+    os.mkdir(_config['results_dir'])
+logger = get_logger('colorlog', _config['loglevel'])
+
+
+# Action
+pairs = [tuple(pair) for pair in _config['pairs']]
+driver = PairsTestDriver(_config, pairs, logger)
+time0 = time()
+results = driver.run(scenario)
+failed = [pair for pair in pairs if results[pair] is not None]
+for pair in pairs:
+    if results[pair] is None:
+        logger.info_ok(u'%s->%s: тест пройден' % pair)
+    else:
+        logger.critical(u'%s->%s: тест провален' % pair)
+logger.info(u'Время прогона: %d сек.' % int(time() - time0))
+sys.exit(1 if failed else 0)
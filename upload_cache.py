@@ -0,0 +1,59 @@
+# coding: utf-8
+import os
+import json
+import hashlib
+from threading import Lock
+
+CHUNK_SIZE = 64 * 1024
+
+
+def pair_sha256(zipfile, xmlfile):
+    """SHA-256 содержимого пары (zip-файл, xml-файл).
+    Перед содержимым каждого файла хэшируется его длина, чтобы граница между файлами
+    не влияла на результат.
+    """
+    sha = hashlib.sha256()
+    for path in (zipfile, xmlfile):
+        sha.update('%d:' % os.path.getsize(path))
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+class UploadCache(object):
+    """Манифест отгрузок: server -> {SHA-256 пары: [id, version, имя объекта]}.
+    Хранится в json-файле filename и позволяет не отгружать повторно объект, который уже есть
+    на сервере (см. Test.put_objects_from_directory).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.entries = {}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def get(self, server, digest):
+        """Вернуть (id, version, name) последней отгрузки пары на сервер server или None"""
+        with self.lock:
+            entry = self.entries.get(server, {}).get(digest)
+        return tuple(entry) if entry is not None else None
+
+    def put(self, server, digest, id, version, name):
+        with self.lock:
+            self.entries.setdefault(server, {})[digest] = [id, version, name]
+
+    def save(self):
+        """Записать манифест (через временный файл, чтобы прерванная запись его не испортила)"""
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmpfile = '%s.tmp' % self.filename
+        with self.lock:
+            with open(tmpfile, 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.rename(tmpfile, self.filename)
@@ -1,7 +1,10 @@
 # coding: utf-8
 from __future__ import print_function
 import sys
-from time import sleep
+from time import sleep, time
+import random
+import ctypes
+import ctypes.util
 import logging
 
 import colorlog
@@ -21,6 +24,96 @@ def wait(seconds):
     print()
 
 
+def _get_monotonic():
+    """Монотонные часы высокого разрешения (clock_gettime(CLOCK_MONOTONIC)).
+    В Python 2 их нет в стандартной библиотеке; если недоступны, используется time().
+    """
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    CLOCK_MONOTONIC = 1
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _get_monotonic()
+
+
+class Poller(object):
+    """Расписание опросов сервера с адаптивным интервалом.
+    Первый опрос выполняется сразу. Далее интервал растёт от min_interval в factor раз
+    (со случайным разбросом ±jitter) до max_interval, а после progress() снова сбрасывается
+    до min_interval. Итерация прекращается, если timeout секунд не было прогресса
+    (до первого прогресса к timeout добавляется first_timeout).
+
+    for _ in poller:
+        ...
+        if нашлось новое: poller.progress()
+        if всё готово: break
+    else:
+        # истекло время
+    """
+    def __init__(self, timeout, first_timeout=0, min_interval=1, max_interval=10, factor=2,
+                 jitter=0.2):
+        self.timeout = timeout
+        self.first_timeout = first_timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.deadline = None
+        self._progress = False
+
+    def __iter__(self):
+        self.deadline = monotonic() + self.first_timeout + self.timeout
+        interval = self.min_interval
+        while True:
+            yield
+            if self._progress:
+                self._progress = False
+                interval = self.min_interval
+            seconds_left = self.deadline - monotonic()
+            if seconds_left <= 0:
+                return
+            delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            sleep(min(delay, self.max_interval, seconds_left))
+            interval = min(interval * self.factor, self.max_interval)
+
+    def progress(self):
+        """Отметить прогресс: отсчёт timeout начинается заново"""
+        self.deadline = monotonic() + self.timeout
+        self._progress = True
+
+    def hold(self):
+        """Не дать опросу закончиться по времени (например, пока ещё идёт отгрузка): отсчёт
+        timeout начинается заново, но интервал опроса не сбрасывается
+        """
+        self.deadline = max(self.deadline, monotonic() + self.timeout)
+
+
+def roundrobin(*lists):
+    """Перемежать элементы списков: a1, b1, a2, b2, b3, ..."""
+    result = []
+    for i in xrange(max(len(l) for l in lists) if lists else 0):
+        for l in lists:
+            if i < len(l):
+                result.append(l[i])
+    return result
+
+
+def chunks(items, size):
+    """Разбить список items на куски длиной не более size"""
+    return [items[i:i+size] for i in xrange(0, len(items), size)]
+
+
 class UnicodeException(Exception):
     def __init__(self, message=''):
         if isinstance(message, unicode):
@@ -36,7 +129,8 @@ class UnicodeException(Exception):
         return self.message
 
 
-def get_logger(name, loglevel='INFO', logfile='log.log'):
+def get_logger(name, loglevel='INFO', logfile='log.log', prefix=''):
+    """prefix -- строка перед каждым сообщением (например, чтобы различать пары серверов)"""
     INFO_OK = 15
     logging.addLevelName(INFO_OK, "INFO_OK")
     def info_ok(self, message, *args, **kwargs):
@@ -46,9 +140,10 @@ def get_logger(name, loglevel='INFO', logfile='log.log'):
     logging.INFO_OK = INFO_OK
     logger = colorlog.getLogger(name)
     logger.setLevel(getattr(logging, loglevel))
+    prefix = prefix.replace('%', '%%')
     consoleHandler = colorlog.StreamHandler()
     consoleHandler.setFormatter(colorlog.ColoredFormatter(
-        '%(log_color)s[%(levelname)s] %(message)s',
+        '%(log_color)s[%(levelname)s] ' + prefix + '%(message)s',
         log_colors = {
             'DEBUG': 'cyan',
             'INFO_OK': 'green',
@@ -59,7 +154,8 @@ def get_logger(name, loglevel='INFO', logfile='log.log'):
         }
     ))
     fileHandler = logging.FileHandler(logfile)
-    fileHandler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)-15s: %(message)s'))
+    fileHandler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)-15s: ' + prefix +
+                                               '%(message)s'))
     logger.addHandler(consoleHandler)
     logger.addHandler(fileHandler)
     logging.getLogger('requests').setLevel(logging.WARNING)